@@ -30,12 +30,39 @@ bl_info = {
     "tracker_url": "http://www.katsbits.com/smforum/index.php?topic=275.0",
     "category": "Import-Export"}
 
-import bpy, struct, math, os, time
+import struct, math, os, sys, time, io, collections, mmap, getopt, multiprocessing, hashlib, json, subprocess, threading, traceback, heapq
+from array import array
+
+try:
+  import bpy
+except ImportError:
+  bpy = None # headless, the md3 core (build_md3 and below) still works
+
+try:
+  import numpy
+except ImportError:
+  numpy = None # bulk stages fall back to plain python
+
+clock = getattr(time, 'perf_counter', None) or time.clock # time.clock is gone since python 3.8
 
 ##### User options: Exporter default settings
 default_logtype = 'overwrite' ## console, overwrite, append
+default_loglevel = 'info' ## warning, info, detail
+default_dumpformat = 'text' ## text, csv, binary
 default_dumpall = False 
 default_triangulate = True
+default_split = True
+default_optimize = False
+default_incremental = False ## reuse the frames of the last export, .md3cache next to the md3
+default_profile = False
+default_tightradius = False
+default_center = False ## move the export into the middle of the md3 range
+default_markers = False ## animation.cfg from the timeline markers
+default_compact = False ## drop repeated frames along an animation.cfg
+default_frametolerance = 0 ## md3 steps a vertex may move in a held frame
+default_jobs = 1 ## worker processes for the frame conversion, 0 for one per cpu
+default_lods = 0 ## extra levels of detail written as name_1.md3, name_2.md3, ...
+default_lodratio = 0.5 ## triangles kept per level of detail
 
 
 MAX_QPATH = 64
@@ -52,17 +79,77 @@ MD3_XYZ_SCALE = 64.0
 
 
 
+def little_endian(data):
+	# array.tobytes() in the md3 byte order
+	if sys.byteorder != 'little':
+		data = array(data.typecode, data)
+		data.byteswap()
+	return data.tobytes()
+
+def xyz_step(value):
+	# one coordinate in md3 fixed point, rounded to the nearest step
+	return int(math.floor(value * MD3_XYZ_SCALE + 0.5))
+
+def quantize_positions(xyz):
+	# float positions (numpy N x 3 or flat) in md3 fixed point steps, not yet
+	# range checked, and (largest error, summed error, vertices, vertices out
+	# of the int16 range) with the error the distance a vertex moves
+	if numpy:
+		xyz = numpy.asarray(xyz, numpy.float64).reshape(-1, 3)
+		steps = numpy.floor(xyz * MD3_XYZ_SCALE + 0.5)
+		if not len(xyz):
+			return steps, (0.0, 0.0, 0, 0)
+		delta = steps / MD3_XYZ_SCALE - xyz
+		error = numpy.sqrt(numpy.einsum('ij,ij->i', delta, delta))
+		outside = int(((steps < -0x8000) | (steps > 0x7FFF)).any(axis=1).sum())
+		return steps, (float(error.max()), float(error.sum()), len(xyz), outside)
+	steps = [xyz_step(value) for value in xyz]
+	largest = total = 0.0
+	outside = 0
+	for i in range(0, len(steps), 3):
+		error = math.sqrt(sum((steps[i + c] / MD3_XYZ_SCALE - xyz[i + c]) ** 2 for c in range(0,3)))
+		largest = max(largest, error)
+		total += error
+		if min(steps[i:i + 3]) < -0x8000 or max(steps[i:i + 3]) > 0x7FFF:
+			outside += 1
+	return steps, (largest, total, len(steps) // 3, outside)
+
+def pack_vertices(steps, normals):
+	# md3 vertex records (array of int16 x, y, z, normal) of one frame of a
+	# surface from quantize_positions steps in range, normals: encoded uint16
+	count = len(normals)
+	if numpy:
+		record = numpy.empty((count, 4), numpy.int16)
+		record[:, :3] = steps
+		record[:, 3] = numpy.asarray(normals, numpy.uint16).view(numpy.int16)
+		return array('h', record.tobytes())
+	record = array('h')
+	for i in range(0, count):
+		normal = normals[i]
+		if normal > 0x7FFF:
+			normal -= 0x10000
+		record.extend((steps[i * 3], steps[i * 3 + 1], steps[i * 3 + 2], normal))
+	return record
+
+def pack_frame(xyz, normals, name=""):
+	# pack_vertices of float positions (numpy N x 3 or flat), name is for
+	# the error when a vertex does not fit
+	steps, error = quantize_positions(xyz)
+	if error[3]:
+		raise OverflowError("vertex outside of the md3 range in surface " + name)
+	return pack_vertices(steps, normals)
+
 class md3Vert:
-	xyz = []
-	normal = 0
+	__slots__ = ("xyz", "normal")
 	binaryFormat = "<3hH"
+	binaryStruct = struct.Struct(binaryFormat)
 	
 	def __init__(self):
 		self.xyz = [0.0, 0.0, 0.0]
 		self.normal = 0
 		
 	def GetSize(self):
-		return struct.calcsize(self.binaryFormat)
+		return self.binaryStruct.size
 	
 	# copied from PhaethonH <phaethon@linux.ucla.edu> md3.py
 	def Decode(self, latlng):
@@ -102,70 +189,71 @@ class md3Vert:
 		
 	def Save(self, file):
 		tmpData = [0] * 4
-		tmpData[0] = int(self.xyz[0] * MD3_XYZ_SCALE)
-		tmpData[1] = int(self.xyz[1] * MD3_XYZ_SCALE)
-		tmpData[2] = int(self.xyz[2] * MD3_XYZ_SCALE)
+		tmpData[0] = xyz_step(self.xyz[0])
+		tmpData[1] = xyz_step(self.xyz[1])
+		tmpData[2] = xyz_step(self.xyz[2])
 		tmpData[3] = self.normal
-		data = struct.pack(self.binaryFormat, tmpData[0], tmpData[1], tmpData[2], tmpData[3])
+		data = self.binaryStruct.pack(tmpData[0], tmpData[1], tmpData[2], tmpData[3])
 		file.write(data)
 		
 class md3TexCoord:
-	u = 0.0
-	v = 0.0
+	__slots__ = ("u", "v")
 
 	binaryFormat = "<2f"
+	binaryStruct = struct.Struct(binaryFormat)
 
 	def __init__(self):
 		self.u = 0.0
 		self.v = 0.0
 		
 	def GetSize(self):
-		return struct.calcsize(self.binaryFormat)
+		return self.binaryStruct.size
 
 	def Save(self, file):
 		tmpData = [0] * 2
 		tmpData[0] = self.u
 		tmpData[1] = 1.0 - self.v
-		data = struct.pack(self.binaryFormat, tmpData[0], tmpData[1])
+		data = self.binaryStruct.pack(tmpData[0], tmpData[1])
 		file.write(data)
 
 class md3Triangle:
-	indexes = []
+	__slots__ = ("indexes",)
 
 	binaryFormat = "<3i"
+	binaryStruct = struct.Struct(binaryFormat)
 
 	def __init__(self):
 		self.indexes = [ 0, 0, 0 ]
 		
 	def GetSize(self):
-		return struct.calcsize(self.binaryFormat)
+		return self.binaryStruct.size
 
 	def Save(self, file):
 		tmpData = [0] * 3
 		tmpData[0] = self.indexes[0]
 		tmpData[1] = self.indexes[2] # reverse
 		tmpData[2] = self.indexes[1] # reverse
-		data = struct.pack(self.binaryFormat,tmpData[0], tmpData[1], tmpData[2])
+		data = self.binaryStruct.pack(tmpData[0], tmpData[1], tmpData[2])
 		file.write(data)
 
 class md3Shader:
-	name = ""
-	index = 0
+	__slots__ = ("name", "index")
 	
 	binaryFormat = "<%dsi" % MAX_QPATH
+	binaryStruct = struct.Struct(binaryFormat)
 
 	def __init__(self):
 		self.name = ""
 		self.index = 0
 		
 	def GetSize(self):
-		return struct.calcsize(self.binaryFormat)
+		return self.binaryStruct.size
 
 	def Save(self, file):
 		tmpData = [0] * 2
 		tmpData[0] = str.encode(self.name)
 		tmpData[1] = self.index
-		data = struct.pack(self.binaryFormat, tmpData[0], tmpData[1])
+		data = self.binaryStruct.pack(tmpData[0], tmpData[1])
 		file.write(data)
 
 class md3Surface:
@@ -185,8 +273,10 @@ class md3Surface:
 	triangles = []
 	uv = []
 	verts = []
+	xyznormals = None	# optional compact frames, see AllocFrames
 	
 	binaryFormat = "<4s%ds10i" % MAX_QPATH  # 1 int, name, then 10 ints
+	binaryStruct = struct.Struct(binaryFormat)
 	
 	def __init__(self):
 		self.ident = ""
@@ -200,26 +290,59 @@ class md3Surface:
 		self.ofsShaders = 0
 		self.ofsUV = 0
 		self.ofsVerts = 0
-		self.ofsEnd
+		self.ofsEnd = 0
 		self.shaders = []
 		self.triangles = []
 		self.uv = []
 		self.verts = []
+		self.xyznormals = None
+
+	def AllocFrames(self, numFrames):
+		# Keeps the frames as the md3 records themselves instead of md3Vert
+		# objects: 3 int16 xyz and the uint16 normal (stored as int16) per
+		# vertex, numFrames x numVerts of them in one preallocated array
+		self.numFrames = numFrames
+		self.verts = []
+		self.xyznormals = array('h', bytes(8 * self.numVerts * numFrames))
+
+	def SetFrameRecord(self, frame_index, record):
+		# one frame of records from pack_frame
+		count = self.numVerts * 4
+		start = frame_index * count
+		self.xyznormals[start:start + count] = record
+
+	def SetFrameData(self, frame_index, data):
+		# one frame as stored in a md3 file (little endian records), e.g.
+		# spliced from a previous export
+		count = self.numVerts * 4
+		start = frame_index * count
+		record = array('h', bytes(data))
+		if sys.byteorder != 'little':
+			record.byteswap()
+		self.xyznormals[start:start + count] = record
+
+	def SelectFrames(self, order):
+		# keeps the frames of order (old frame indexes, repeats allowed)
+		count = self.numVerts * 4
+		xyznormals = array('h')
+		for frame_index in order:
+			xyznormals.extend(self.xyznormals[frame_index * count:(frame_index + 1) * count])
+		self.xyznormals = xyznormals
+		self.numFrames = len(order)
 		
 	def GetSize(self):
-		sz = struct.calcsize(self.binaryFormat)
+		# offsets follow from the element counts, nothing is visited
+		sz = self.binaryStruct.size
 		self.ofsTriangles = sz
-		for t in self.triangles:
-			sz += t.GetSize()
+		sz += len(self.triangles) * md3Triangle.binaryStruct.size
 		self.ofsShaders = sz
-		for s in self.shaders:
-			sz += s.GetSize()
+		sz += len(self.shaders) * md3Shader.binaryStruct.size
 		self.ofsUV = sz
-		for u in self.uv:
-			sz += u.GetSize()
+		sz += len(self.uv) * md3TexCoord.binaryStruct.size
 		self.ofsVerts = sz
-		for v in self.verts:
-			sz += v.GetSize()
+		sz += len(self.verts) * md3Vert.binaryStruct.size
+		if self.xyznormals is not None:
+			sz += self.xyznormals.itemsize * len(self.xyznormals)
 		self.ofsEnd = sz
 		return self.ofsEnd
 	
@@ -238,31 +361,49 @@ class md3Surface:
 		tmpData[9] = self.ofsUV
 		tmpData[10] = self.ofsVerts
 		tmpData[11] = self.ofsEnd
-		data = struct.pack(self.binaryFormat, tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6],tmpData[7],tmpData[8],tmpData[9],tmpData[10],tmpData[11])
-		file.write(data)
+		data = bytearray(self.binaryStruct.pack(tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6],tmpData[7],tmpData[8],tmpData[9],tmpData[10],tmpData[11]))
 
-		# write the tri data
-		for t in self.triangles:
-			t.Save(file)
+		# each section is packed from a flat array and the whole surface
+		# leaves with a single write
+		data += little_endian(self.TriangleData())
 
 		# save the shader coordinates
 		for s in self.shaders:
-			s.Save(file)
+			data += s.binaryStruct.pack(str.encode(s.name), s.index)
+
+		data += little_endian(self.UVData())
+		data += little_endian(self.VertexData())
+		file.write(data)
+
+	def TriangleData(self):
+		indexes = array('i')
+		for t in self.triangles:
+			indexes.extend((t.indexes[0], t.indexes[2], t.indexes[1])) # reverse
+		return indexes
 
-		# save the uv info
+	def UVData(self):
+		st = array('f')
 		for u in self.uv:
-			u.Save(file)
+			st.extend((u.u, 1.0 - u.v))
+		return st
 
-		# save the verts
+	def VertexData(self):
+		# xyz and the normal as int16, the normal is stored unsigned
+		if self.xyznormals is not None:
+			return self.xyznormals
+		xyzn = array('h')
 		for v in self.verts:
-			v.Save(file)
+			normal = v.normal
+			if normal > 0x7FFF:
+				normal -= 0x10000
+			xyzn.extend((xyz_step(v.xyz[0]), xyz_step(v.xyz[1]), xyz_step(v.xyz[2]), normal))
+		return xyzn
 
 class md3Tag:
-	name = ""
-	origin = []
-	axis = []
+	__slots__ = ("name", "origin", "axis")
 	
 	binaryFormat="<%ds3f9f" % MAX_QPATH
+	binaryStruct = struct.Struct(binaryFormat)
 	
 	def __init__(self):
 		self.name = ""
@@ -270,7 +411,7 @@ class md3Tag:
 		self.axis = [0, 0, 0, 0, 0, 0, 0, 0, 0]
 		
 	def GetSize(self):
-		return struct.calcsize(self.binaryFormat)
+		return self.binaryStruct.size
 		
 	def Save(self, file):
 		tmpData = [0] * 13
@@ -287,17 +428,14 @@ class md3Tag:
 		tmpData[10] = float(self.axis[6])
 		tmpData[11] = float(self.axis[7])
 		tmpData[12] = float(self.axis[8])
-		data = struct.pack(self.binaryFormat, tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6], tmpData[7], tmpData[8], tmpData[9], tmpData[10], tmpData[11], tmpData[12])
+		data = self.binaryStruct.pack(tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6], tmpData[7], tmpData[8], tmpData[9], tmpData[10], tmpData[11], tmpData[12])
 		file.write(data)
 	
 class md3Frame:
-	mins = 0
-	maxs = 0
-	localOrigin = 0
-	radius = 0.0
-	name = ""
+	__slots__ = ("mins", "maxs", "localOrigin", "radius", "name")
 	
 	binaryFormat="<3f3f3ff16s"
+	binaryStruct = struct.Struct(binaryFormat)
 	
 	def __init__(self):
 		self.mins = [0, 0, 0]
@@ -307,7 +445,7 @@ class md3Frame:
 		self.name = ""
 		
 	def GetSize(self):
-		return struct.calcsize(self.binaryFormat)
+		return self.binaryStruct.size
 
 	def Save(self, file):
 		tmpData = [0] * 11
@@ -322,7 +460,7 @@ class md3Frame:
 		tmpData[8] = self.localOrigin[2]
 		tmpData[9] = self.radius
 		tmpData[10] = str.encode("frame" + self.name)
-		data = struct.pack(self.binaryFormat, tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6],tmpData[7], tmpData[8], tmpData[9], tmpData[10])
+		data = self.binaryStruct.pack(tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6],tmpData[7], tmpData[8], tmpData[9], tmpData[10])
 		file.write(data)
 
 class md3Object:
@@ -344,6 +482,7 @@ class md3Object:
 	surfaces = []
 
 	binaryFormat="<4si%ds9i" % MAX_QPATH  # little-endian (<), 17 integers (17i)
+	binaryStruct = struct.Struct(binaryFormat)
 
 	def __init__(self):
 		self.ident = 0
@@ -363,17 +502,21 @@ class md3Object:
 		self.surfaces = []
 
 	def GetSize(self):
-		self.ofsFrames = struct.calcsize(self.binaryFormat)
-		self.ofsTags = self.ofsFrames
-		for f in self.frames:
-			self.ofsTags += f.GetSize()
-		self.ofsSurfaces += self.ofsTags
-		for t in self.tags:
-			self.ofsSurfaces += t.GetSize()
+		self.ofsFrames = self.binaryStruct.size
+		self.ofsTags = self.ofsFrames + len(self.frames) * md3Frame.binaryStruct.size
+		self.ofsSurfaces = self.ofsTags + len(self.tags) * md3Tag.binaryStruct.size
 		self.ofsEnd = self.ofsSurfaces
 		for s in self.surfaces:
 			self.ofsEnd += s.GetSize()
 		return self.ofsEnd
+
+	def SelectFrames(self, order):
+		# keeps the frames of order (old frame indexes) with their tags
+		self.frames = [self.frames[frame_index] for frame_index in order]
+		self.tags = [tag for frame_index in order for tag in self.tags[frame_index * self.numTags:(frame_index + 1) * self.numTags]]
+		self.numFrames = len(order)
+		for s in self.surfaces:
+			s.SelectFrames(order)
 		
 	def Save(self, file):
 		self.GetSize()
@@ -391,32 +534,338 @@ class md3Object:
 		tmpData[10] = self.ofsSurfaces
 		tmpData[11] = self.ofsEnd
 
-		data = struct.pack(self.binaryFormat, tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6],tmpData[7], tmpData[8], tmpData[9], tmpData[10], tmpData[11])
-		file.write(data)
+		data = io.BytesIO()
+		data.write(self.binaryStruct.pack(tmpData[0],tmpData[1],tmpData[2],tmpData[3],tmpData[4],tmpData[5],tmpData[6],tmpData[7], tmpData[8], tmpData[9], tmpData[10], tmpData[11]))
 
 		for f in self.frames:
-			f.Save(file)
+			f.Save(data)
 			
 		for t in self.tags:
-			t.Save(file)
+			t.Save(data)
+		file.write(data.getvalue())
 			
 		for s in self.surfaces:
 			s.Save(file)
 
+def cstring(data):
+	# null padded md3 string to str
+	return bytes(data).split(b"\0", 1)[0].decode("utf-8", "replace")
+
+class md3SurfaceReader:
+	# one surface of a md3Reader, the header is unpacked, the blocks are views
+	def __init__(self, reader, offset):
+		self.reader = reader
+		self.offset = offset
+		header = reader.Unpack(md3Surface.binaryStruct, offset)
+		self.ident = cstring(header[0])
+		self.name = cstring(header[1])
+		self.flags = header[2]
+		self.numFrames = header[3]
+		self.numShaders = header[4]
+		self.numVerts = header[5]
+		self.numTriangles = header[6]
+		self.ofsTriangles = header[7]
+		self.ofsShaders = header[8]
+		self.ofsUV = header[9]
+		self.ofsVerts = header[10]
+		self.ofsEnd = header[11]
 
-def message(log,msg):
+	def Triangles(self):
+		# numTriangles x 3 int32, in file (reversed) winding
+		return self.reader.View(self.offset + self.ofsTriangles, self.numTriangles * 3, 'i', 3)
+
+	def Shaders(self):
+		shaders = []
+		for i in range(0, self.numShaders):
+			name, index = self.reader.Unpack(md3Shader.binaryStruct, self.offset + self.ofsShaders + i * md3Shader.binaryStruct.size)
+			nshader = md3Shader()
+			nshader.name = cstring(name)
+			nshader.index = index
+			shaders.append(nshader)
+		return shaders
+
+	def UV(self):
+		# numVerts x 2 float32, v flipped as stored
+		return self.reader.View(self.offset + self.ofsUV, self.numVerts * 2, 'f', 2)
+
+	def FrameData(self, frame_index):
+		# raw bytes of one frame of vertex records
+		size = self.numVerts * md3Vert.binaryStruct.size
+		return self.reader.Data(self.offset + self.ofsVerts + frame_index * size, size)
+
+	def XyzNormals(self, frame_index=None):
+		# numVerts x 4 int16 (x, y, z, normal) of one frame, or all frames
+		# when frame_index is None. Only the requested frame is touched
+		size = self.numVerts * 4
+		if frame_index is None:
+			return self.reader.View(self.offset + self.ofsVerts, size * self.numFrames, 'h', 4)
+		if frame_index < 0 or frame_index >= self.numFrames:
+			raise IndexError("frame " + str(frame_index) + " out of range in surface " + self.name)
+		return self.reader.View(self.offset + self.ofsVerts + frame_index * size * 2, size, 'h', 4)
+
+class md3Reader:
+	# Reads a md3 file back without parsing all of it: the file is memory
+	# mapped and frames, tags and surface blocks are unpacked or viewed on
+	# access only. Views are numpy arrays on the mapping when numpy is there,
+	# flat memoryviews otherwise (a copy on big endian or old pythons)
+	def __init__(self, filepath):
+		self.filepath = filepath
+		self.file = open(filepath, "rb")
+		self.map = None
+		try:
+			self.size = os.fstat(self.file.fileno()).st_size
+			if self.size < md3Object.binaryStruct.size:
+				raise ValueError(filepath + " is too small for a md3 header")
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			header = self.Unpack(md3Object.binaryStruct, 0)
+			self.ident = cstring(header[0])
+			self.version = header[1]
+			self.name = cstring(header[2])
+			self.flags = header[3]
+			self.numFrames = header[4]
+			self.numTags = header[5]
+			self.numSurfaces = header[6]
+			self.numSkins = header[7]
+			self.ofsFrames = header[8]
+			self.ofsTags = header[9]
+			self.ofsSurfaces = header[10]
+			self.ofsEnd = header[11]
+
+			# surface headers are chained by their ofsEnd
+			self.surfaces = []
+			offset = self.ofsSurfaces
+			for i in range(0, self.numSurfaces):
+				surface = md3SurfaceReader(self, offset)
+				self.surfaces.append(surface)
+				if surface.ofsEnd <= 0:
+					raise ValueError("surface " + surface.name + " has no size in " + filepath)
+				offset += surface.ofsEnd
+		except:
+			# nothing stays open on a corrupt file
+			self.Close()
+			raise
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.Close()
+
+	def Close(self):
+		try:
+			if self.map is not None:
+				self.map.close()
+		except BufferError:
+			pass # views are still alive, the mapping goes with the last one
+		self.file.close()
+
+	def Check(self, offset, size):
+		if offset < 0 or offset + size > self.size:
+			raise ValueError("block at " + str(offset) + " (" + str(size) + " bytes) is outside of " + self.filepath)
+
+	def Unpack(self, binaryStruct, offset):
+		self.Check(offset, binaryStruct.size)
+		return binaryStruct.unpack_from(self.map, offset)
+
+	def Data(self, offset, size):
+		# raw bytes of the file, zero copy
+		self.Check(offset, size)
+		return memoryview(self.map)[offset:offset + size]
+
+	def View(self, offset, count, typecode, columns=1):
+		# count little endian items of the array typecode at offset
+		itemsize = array(typecode).itemsize
+		data = self.Data(offset, count * itemsize)
+		if numpy:
+			view = numpy.frombuffer(data, numpy.dtype(typecode).newbyteorder('<'), count)
+			return view.reshape(-1, columns) if columns > 1 else view
+		if sys.byteorder == 'little' and hasattr(data, "cast"):
+			return data.cast(typecode)
+		items = array(typecode, bytes(data))
+		if sys.byteorder != 'little':
+			items.byteswap()
+		return memoryview(items)
+
+	def FrameData(self, frame_index):
+		return self.Data(self.ofsFrames + frame_index * md3Frame.binaryStruct.size, md3Frame.binaryStruct.size)
+
+	def Frame(self, frame_index):
+		if frame_index < 0 or frame_index >= self.numFrames:
+			raise IndexError("frame " + str(frame_index) + " out of range")
+		data = self.Unpack(md3Frame.binaryStruct, self.ofsFrames + frame_index * md3Frame.binaryStruct.size)
+		nframe = md3Frame()
+		nframe.mins = list(data[0:3])
+		nframe.maxs = list(data[3:6])
+		nframe.localOrigin = list(data[6:9])
+		nframe.radius = data[9]
+		nframe.name = cstring(data[10])
+		if nframe.name.startswith("frame"):
+			nframe.name = nframe.name[5:] # Save puts it back
+		return nframe
+
+	def TagData(self, frame_index):
+		# all tags of one frame
+		return self.Data(self.ofsTags + frame_index * self.numTags * md3Tag.binaryStruct.size, self.numTags * md3Tag.binaryStruct.size)
+
+	def Tag(self, frame_index, tag_index):
+		if frame_index < 0 or frame_index >= self.numFrames or tag_index < 0 or tag_index >= self.numTags:
+			raise IndexError("tag " + str(tag_index) + " of frame " + str(frame_index) + " out of range")
+		data = self.Unpack(md3Tag.binaryStruct, self.ofsTags + (frame_index * self.numTags + tag_index) * md3Tag.binaryStruct.size)
+		ntag = md3Tag()
+		ntag.name = cstring(data[0])
+		ntag.origin = list(data[1:4])
+		ntag.axis = list(data[4:13])
+		return ntag
+
+class md3WeldIndex:
+	# welds face corners into md3 vertices, a corner is shared when both the
+	# blender vertex and the (rounded) uv match an already emitted vertex
+	surface = None
+	vertlist = []
+	lookup = {}
+
+	def __init__(self, surface):
+		self.surface = surface
+		self.vertlist = []
+		self.lookup = {}
+
+	def Weld(self, vert_index, uv_u, uv_v):
+		key = (vert_index, uv_u, uv_v)
+		index = self.lookup.get(key)
+		if index is None:
+			index = self.surface.numVerts
+			self.lookup[key] = index
+			self.vertlist.append(vert_index)
+			ntex = md3TexCoord()
+			ntex.u = uv_u
+			ntex.v = uv_v
+			self.surface.uv.append(ntex)
+			self.surface.numVerts += 1
+		return index
+
+# unit test for md3WeldIndex, compares against the old linear vertlist scan
+class md3WeldIndexTest:
+	def __init__(self):
+		corners = []
+		for f in range(200):
+			for v in range(3):
+				vert_index = (f * 7 + v * 13) % 97
+				corners.append((vert_index, round((vert_index % 5) * 0.25, 5), round((f % 3) * 0.5, 5)))
+
+		# old path
+		old_surface = md3Surface()
+		vertlist = []
+		for c,(vert_index, uv_u, uv_v) in enumerate(corners):
+			if c % 3 == 0:
+				ntri = md3Triangle()
+				old_surface.triangles.append(ntri)
+			match = 0
+			match_index = 0
+			for i,vi in enumerate(vertlist):
+				if vi == vert_index:
+					if old_surface.uv[i].u == uv_u and old_surface.uv[i].v == uv_v:
+						match = 1
+						match_index = i
+			if match == 0:
+				vertlist.append(vert_index)
+				ntri.indexes[c % 3] = old_surface.numVerts
+				ntex = md3TexCoord()
+				ntex.u = uv_u
+				ntex.v = uv_v
+				old_surface.uv.append(ntex)
+				old_surface.numVerts += 1
+			else:
+				ntri.indexes[c % 3] = match_index
+
+		# weld index
+		new_surface = md3Surface()
+		weld = md3WeldIndex(new_surface)
+		for c,(vert_index, uv_u, uv_v) in enumerate(corners):
+			if c % 3 == 0:
+				ntri = md3Triangle()
+				new_surface.triangles.append(ntri)
+			ntri.indexes[c % 3] = weld.Weld(vert_index, uv_u, uv_v)
+
+		assert vertlist == weld.vertlist
+		for s in (old_surface, new_surface):
+			s.ident = MD3_IDENT
+			s.numTriangles = len(s.triangles)
+		old_file = io.BytesIO()
+		new_file = io.BytesIO()
+		old_surface.Save(old_file)
+		new_surface.Save(new_file)
+		assert old_file.getvalue() == new_file.getvalue()
+		print("md3WeldIndexTest: " + str(len(corners)) + " corners welded to " + str(new_surface.numVerts) + " verts, output identical")
+
+
+LOG_WARNING = 0
+LOG_INFO = 1
+LOG_DETAIL = 2
+log_levels = {"warning": LOG_WARNING, "info": LOG_INFO, "detail": LOG_DETAIL}
+
+def message(log,msg,level=LOG_INFO):
   if log:
-    log.write(msg + "\n")
+    if level <= getattr(log, "level", level):
+      log.write(msg + "\n")
   else:
     print(msg)
 
+class md3Log:
+  # Buffered log sink for message(): text collects in memory and leaves in
+  # large writes, messages above level are dropped. Without a filepath it
+  # logs to the console
+  def __init__(self, filepath=None, mode="w", level=LOG_INFO, buffersize=1 << 20):
+    self.filepath = filepath
+    self.level = level
+    self.buffersize = buffersize
+    self.buffer = []
+    self.buffered = 0
+    if filepath:
+      self.file = open(filepath, mode)
+    else:
+      self.file = sys.stdout
+
+  def write(self, text):
+    self.buffer.append(text)
+    self.buffered += len(text)
+    if self.buffered >= self.buffersize:
+      self.flush()
+
+  def flush(self):
+    if self.buffer:
+      self.file.write("".join(self.buffer))
+      self.buffer = []
+      self.buffered = 0
+    self.file.flush()
+
+  def close(self):
+    self.flush()
+    if self.filepath:
+      self.file.close()
+
 class md3Settings:
   def __init__(self,
                savepath,
                name,
                logtype,
                dumpall=False,
+               loglevel="info",
+               dumpformat="text",
                triangulate=False,
+               split=False,
+               optimize=False,
+               incremental=False,
+               profile=False,
+               tightradius=False,
+               center=False,
+               markers=False,
+               animations="",
+               compact=False,
+               animationcfg="",
+               frametolerance=0,
+               jobs=1,
+               lods=0,
+               lodratio=0.5,
                scale=1.0,
                offsetx=0.0,
                offsety=0.0,
@@ -425,13 +874,69 @@ class md3Settings:
     self.name = name
     self.logtype = logtype
     self.dumpall = dumpall
+    self.loglevel = loglevel
+    self.dumpformat = dumpformat
     self.triangulate = triangulate
+    self.split = split
+    self.optimize = optimize
+    self.incremental = incremental
+    self.profile = profile
+    self.tightradius = tightradius
+    self.center = center
+    self.markers = markers
+    self.animations = animations
+    self.compact = compact
+    self.animationcfg = animationcfg
+    self.frametolerance = frametolerance
+    self.jobs = jobs
+    self.lods = lods
+    self.lodratio = lodratio
     self.scale = scale
     self.offsetx = offsetx
     self.offsety = offsety
     self.offsetz = offsetz
 
-def print_md3(log,md3,dumpall):
+class md3Stats:
+  # wall time and counters per export stage, e.g.
+  #   with stats.Stage("packing"):
+  #     ...
+  #   stats.Count("frames packed")
+  def __init__(self):
+    self.times = collections.OrderedDict()
+    self.calls = collections.OrderedDict()
+    self.counts = collections.OrderedDict()
+    self.running = []
+
+  def Stage(self, name):
+    self.running.append((name, clock()))
+    return self
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    name, start = self.running.pop()
+    self.times[name] = self.times.get(name, 0.0) + clock() - start
+    self.calls[name] = self.calls.get(name, 0) + 1
+
+  def Count(self, name, count=1):
+    self.counts[name] = self.counts.get(name, 0) + count
+
+  def Report(self, log):
+    for name,seconds in self.times.items():
+      message(log,"Stage " + name + ": " + str(round(seconds,5)) + " seconds (" + str(self.calls[name]) + "x)")
+    for name,count in self.counts.items():
+      message(log,"Count " + name + ": " + str(count))
+
+  def Save(self, filepath):
+    stages = [{"stage": name, "seconds": seconds, "calls": self.calls[name]} for name,seconds in self.times.items()]
+    file = open(filepath, "w")
+    json.dump({"stages": stages, "counts": self.counts}, file, indent=1)
+    file.close()
+
+def print_md3(log,md3,dumpall,dumppath=None):
+  # dumpall lists every section of the md3, vertices go to dumppath instead
+  # when it is given (.csv or .bin, see dump_md3_vertices)
   message(log,"Header Information")
   message(log,"Ident: " + str(md3.ident))
   message(log,"Version: " + str(md3.version))
@@ -447,50 +952,63 @@ def print_md3(log,md3,dumpall):
   message(log,"Offset end: " + str(md3.ofsEnd))
   
   if dumpall:
-    message(log,"Frames:")
+    # every section is formatted as a whole and logged in one message
+    lines = ["Frames:"]
     for f in md3.frames:
-      message(log," Mins: " + str(f.mins[0]) + " " + str(f.mins[1]) + " " + str(f.mins[2]))
-      message(log," Maxs: " + str(f.maxs[0]) + " " + str(f.maxs[1]) + " " + str(f.maxs[2]))
-      message(log," Origin(local): " + str(f.localOrigin[0]) + " " + str(f.localOrigin[1]) + " " + str(f.localOrigin[2]))
-      message(log," Radius: " + str(f.radius))
-      message(log," Name: " + f.name)
+      lines.append(" Mins: " + str(f.mins[0]) + " " + str(f.mins[1]) + " " + str(f.mins[2]))
+      lines.append(" Maxs: " + str(f.maxs[0]) + " " + str(f.maxs[1]) + " " + str(f.maxs[2]))
+      lines.append(" Origin(local): " + str(f.localOrigin[0]) + " " + str(f.localOrigin[1]) + " " + str(f.localOrigin[2]))
+      lines.append(" Radius: " + str(f.radius))
+      lines.append(" Name: " + f.name)
 
-    message(log,"Tags:")
+    lines.append("Tags:")
     for t in md3.tags:
-      message(log," Name: " + t.name)
-      message(log," Origin: " + str(t.origin[0]) + " " + str(t.origin[1]) + " " + str(t.origin[2]))
-      message(log," Axis[0]: " + str(t.axis[0]) + " " + str(t.axis[1]) + " " + str(t.axis[2]))
-      message(log," Axis[1]: " + str(t.axis[3]) + " " + str(t.axis[4]) + " " + str(t.axis[5]))
-      message(log," Axis[2]: " + str(t.axis[6]) + " " + str(t.axis[7]) + " " + str(t.axis[8]))
+      lines.append(" Name: " + t.name)
+      lines.append(" Origin: " + str(t.origin[0]) + " " + str(t.origin[1]) + " " + str(t.origin[2]))
+      lines.append(" Axis[0]: " + str(t.axis[0]) + " " + str(t.axis[1]) + " " + str(t.axis[2]))
+      lines.append(" Axis[1]: " + str(t.axis[3]) + " " + str(t.axis[4]) + " " + str(t.axis[5]))
+      lines.append(" Axis[2]: " + str(t.axis[6]) + " " + str(t.axis[7]) + " " + str(t.axis[8]))
+    message(log,"\n".join(lines))
 
     message(log,"Surfaces:")
     for s in md3.surfaces:
-      message(log," Ident: " + s.ident)
-      message(log," Name: " + s.name)
-      message(log," Flags: " + str(s.flags))
-      message(log," # of Frames: " + str(s.numFrames))
-      message(log," # of Shaders: " + str(s.numShaders))
-      message(log," # of Verts: " + str(s.numVerts))
-      message(log," # of Triangles: " + str(s.numTriangles))
-      message(log," Offset Triangles: " + str(s.ofsTriangles))
-      message(log," Offset UVs: " + str(s.ofsUV))
-      message(log," Offset Verts: " + str(s.ofsVerts))
-      message(log," Offset End: " + str(s.ofsEnd))
-      message(log," Shaders:")
+      lines = []
+      lines.append(" Ident: " + s.ident)
+      lines.append(" Name: " + s.name)
+      lines.append(" Flags: " + str(s.flags))
+      lines.append(" # of Frames: " + str(s.numFrames))
+      lines.append(" # of Shaders: " + str(s.numShaders))
+      lines.append(" # of Verts: " + str(s.numVerts))
+      lines.append(" # of Triangles: " + str(s.numTriangles))
+      lines.append(" Offset Triangles: " + str(s.ofsTriangles))
+      lines.append(" Offset UVs: " + str(s.ofsUV))
+      lines.append(" Offset Verts: " + str(s.ofsVerts))
+      lines.append(" Offset End: " + str(s.ofsEnd))
+      lines.append(" Shaders:")
       for shader in s.shaders:
-        message(log,"  Name: " + shader.name)
-        message(log,"  Index: " + str(shader.index))
-      message(log," Triangles:")
-      for tri in s.triangles:
-        message(log,"  Indexes: " + str(tri.indexes[0]) + " " + str(tri.indexes[1]) + " " + str(tri.indexes[2]))
-      message(log," UVs:")
-      for uv in s.uv:
-        message(log,"  U: " + str(uv.u))
-        message(log,"  V: " + str(uv.v)) 
-      message(log," Verts:")
-      for vert in s.verts:
-        message(log,"  XYZ: " + str(vert.xyz[0]) + " " + str(vert.xyz[1]) + " " + str(vert.xyz[2]))
-        message(log,"  Normal: " + str(vert.normal))
+        lines.append("  Name: " + shader.name)
+        lines.append("  Index: " + str(shader.index))
+      lines.append(" Triangles:")
+      lines.extend(["  Indexes: %d %d %d" % (tri.indexes[0], tri.indexes[1], tri.indexes[2]) for tri in s.triangles])
+      lines.append(" UVs:")
+      lines.extend(["  U: %r\n  V: %r" % (uv.u, uv.v) for uv in s.uv])
+      lines.append(" Verts:")
+      if dumppath:
+        lines.append("  (in " + dumppath + ")")
+      else:
+        lines.extend(["  XYZ: %r %r %r\n  Normal: %d" % (vert.xyz[0], vert.xyz[1], vert.xyz[2], vert.normal) for vert in s.verts])
+        if s.xyznormals is not None:
+          if numpy:
+            xyzn = numpy.frombuffer(s.xyznormals, numpy.int16).reshape(-1, 4)
+            xyz = (xyzn[:, :3] / MD3_XYZ_SCALE).tolist()
+            normals = xyzn[:, 3].view(numpy.uint16).tolist()
+            lines.extend(["  XYZ: %r %r %r\n  Normal: %d" % (x, y, z, n) for (x, y, z),n in zip(xyz, normals)])
+          else:
+            xyzn = s.xyznormals
+            lines.extend(["  XYZ: %r %r %r\n  Normal: %d" % (xyzn[i] / MD3_XYZ_SCALE, xyzn[i + 1] / MD3_XYZ_SCALE, xyzn[i + 2] / MD3_XYZ_SCALE, xyzn[i + 3] & 0xFFFF) for i in range(0, len(xyzn), 4)])
+      message(log,"\n".join(lines))
+    if dumppath:
+      dump_md3_vertices(md3, dumppath)
 
   shader_count = 0
   vert_count = 0
@@ -500,74 +1018,807 @@ def print_md3(log,md3,dumpall):
     tri_count += surface.numTriangles
     vert_count += surface.numVerts
     if surface.numShaders >= MD3_MAX_SHADERS:
-      message(log,"!Warning: Shader limit (" + str(surface.numShaders) + "/" + str(MD3_MAX_SHADERS) + ") reached for surface " + surface.name)
+      message(log,"!Warning: Shader limit (" + str(surface.numShaders) + "/" + str(MD3_MAX_SHADERS) + ") reached for surface " + surface.name, LOG_WARNING)
     if surface.numVerts >= MD3_MAX_VERTICES:
-      message(log,"!Warning: Vertex limit (" + str(surface.numVerts) + "/" + str(MD3_MAX_VERTICES) + ") reached for surface " + surface.name)
+      message(log,"!Warning: Vertex limit (" + str(surface.numVerts) + "/" + str(MD3_MAX_VERTICES) + ") reached for surface " + surface.name, LOG_WARNING)
     if surface.numTriangles >= MD3_MAX_TRIANGLES:
-      message(log,"!Warning: Triangle limit (" + str(surface.numTriangles) + "/" + str(MD3_MAX_TRIANGLES) + ") reached for surface " + surface.name)
+      message(log,"!Warning: Triangle limit (" + str(surface.numTriangles) + "/" + str(MD3_MAX_TRIANGLES) + ") reached for surface " + surface.name, LOG_WARNING)
   
   if md3.numTags >= MD3_MAX_TAGS:
-    message(log,"!Warning: Tag limit (" + str(md3.numTags) + "/" + str(MD3_MAX_TAGS) + ") reached for md3!")
+    message(log,"!Warning: Tag limit (" + str(md3.numTags) + "/" + str(MD3_MAX_TAGS) + ") reached for md3!", LOG_WARNING)
   if md3.numSurfaces >= MD3_MAX_SURFACES:
-    message(log,"!Warning: Surface limit (" + str(md3.numSurfaces) + "/" + str(MD3_MAX_SURFACES) + ") reached for md3!")
+    message(log,"!Warning: Surface limit (" + str(md3.numSurfaces) + "/" + str(MD3_MAX_SURFACES) + ") reached for md3!", LOG_WARNING)
   if md3.numFrames >= MD3_MAX_FRAMES:
-    message(log,"!Warning: Frame limit (" + str(md3.numFrames) + "/" + str(MD3_MAX_FRAMES) + ") reached for md3!")
+    message(log,"!Warning: Frame limit (" + str(md3.numFrames) + "/" + str(MD3_MAX_FRAMES) + ") reached for md3!", LOG_WARNING)
     
   message(log,"Total Shaders: " + str(shader_count))
   message(log,"Total Triangles: " + str(tri_count))
   message(log,"Total Vertices: " + str(vert_count))
 
-def save_md3(settings):###################### MAIN BODY     
-  starttime = time.clock()#start timer
-  newlogpath = os.path.splitext(settings.savepath)[0] + ".log"
-  dumpall = settings.dumpall
-  if settings.logtype == "append":
-    log = open(newlogpath,"a")
-  elif settings.logtype == "overwrite":
-    log = open(newlogpath,"w")
-  else:
-    log = 0
-  message(log,"######################BEGIN######################")
-  bpy.ops.object.mode_set(mode='OBJECT')
-  md3 = md3Object()
-  md3.ident = MD3_IDENT
-  md3.version = MD3_VERSION
-  md3.name = settings.name
-  md3.numFrames = (bpy.context.scene.frame_end + 1) - bpy.context.scene.frame_start
-  global actobject
-  global convert_to_tris
-  actobject = bpy.context.scene.objects.active
-  selobjects = bpy.context.selected_objects
+def dump_md3_vertices(md3, dumppath):
+  # The frames of every surface for large models, where a text dump is too
+  # slow to write and read. dumppath ending in .csv gives rows of
+  # surface,frame,vertex,x,y,z,normal; else a binary file of, per surface,
+  # a <64sii (name, numFrames, numVerts) header and the little endian md3
+  # vertex records (int16 x, y, z in 1/64 units, uint16 normal)
+  file = open(dumppath, "wb")
+  for s in md3.surfaces:
+    xyzn = s.VertexData()
+    if not dumppath.lower().endswith(".csv"):
+      file.write(struct.pack("<%dsii" % MAX_QPATH, str.encode(s.name), s.numFrames, s.numVerts))
+      file.write(little_endian(xyzn))
+      continue
+    rows = []
+    for v in range(0, len(xyzn) // 4):
+      rows.append("%s,%d,%d,%r,%r,%r,%d\n" % (s.name, v // s.numVerts, v % s.numVerts, xyzn[v * 4] / MD3_XYZ_SCALE, xyzn[v * 4 + 1] / MD3_XYZ_SCALE, xyzn[v * 4 + 2] / MD3_XYZ_SCALE, xyzn[v * 4 + 3] & 0xFFFF))
+    file.write(str.encode("".join(rows)))
+  file.close()
+
+def transform_positions(positions, matrix, scale, offset):
+  # Applies matrix * co * scale + offset to all welded positions of a frame,
+  # rounded like the exporter always did and kept at float precision
+  # (N x 3 float32 with numpy, a flat array('f') otherwise)
+  affine = [[matrix[r][c] * scale for c in range(0,4)] for r in range(0,3)]
+  for r in range(0,3):
+    affine[r][3] += offset[r]
+  if numpy:
+    affine = numpy.array(affine)
+    xyz = numpy.dot(positions.astype(numpy.float64), affine[:, :3].T) + affine[:, 3]
+    return numpy.round(xyz, 5).astype(numpy.float32)
+  (m00, m01, m02, m03), (m10, m11, m12, m13), (m20, m21, m22, m23) = affine
+  xyz = []
+  for i in range(0, len(positions), 3):
+    x = positions[i]
+    y = positions[i + 1]
+    z = positions[i + 2]
+    xyz.append(round(m00 * x + m01 * y + m02 * z + m03,5))
+    xyz.append(round(m10 * x + m11 * y + m12 * z + m13,5))
+    xyz.append(round(m20 * x + m21 * y + m22 * z + m23,5))
+  return array('f', xyz)
+
+def frame_bounds(positions, sphere=False, center=(0.0, 0.0, 0.0)):
+  # mins, maxs and, with sphere, the largest distance from center (the
+  # frame origin) of one frame of transformed positions (from
+  # transform_positions) as single reductions over the whole array
+  if numpy:
+    if not len(positions):
+      return None, None, None
+    low = positions.min(axis=0).tolist()
+    high = positions.max(axis=0).tolist()
+    reach = None
+    if sphere:
+      delta = positions - numpy.array(center, numpy.float64)
+      reach = math.sqrt(float(numpy.einsum('ij,ij->i', delta, delta).max()))
+    return low, high, reach
+  if not len(positions):
+    return None, None, None
+  low = [min(positions[i::3]) for i in range(0,3)]
+  high = [max(positions[i::3]) for i in range(0,3)]
+  reach = None
+  if sphere:
+    x = [value - center[0] for value in positions[0::3]]
+    y = [value - center[1] for value in positions[1::3]]
+    z = [value - center[2] for value in positions[2::3]]
+    reach = math.sqrt(max(map(lambda a, b, c: a * a + b * b + c * c, x, y, z)))
+  return low, high, reach
+
+normal_cache = {} # encode_normals memo of convert_frames, one per worker process
+
+def convert_frames(job, cache=None, stats=None):
+  # The cpu work of md3MeshBuilder.Build for a chunk of frames: transform,
+  # normal encoding, quantization, packing and bounds. job is (samples,
+  # scale, offset, sphere, parts) with samples the (matrix, positions,
+  # normals, frame origin) of every frame and parts the (name, welded vertex indexes or
+  # None for all) of every surface. A module function for worker processes,
+  # returns the (records of every part, (mins, maxs, reach), quantization
+  # error) of each frame, records is None for frames that do not fit
+  samples, scale, offset, sphere, parts = job
+  if cache is None:
+    cache = normal_cache
+  stats = stats or md3Stats()
+  results = []
+  for matrix, positions, normals, center in samples:
+    ## world matrix, scale and offset in one go, then encode normals
+    with stats.Stage("transform"):
+      positions = transform_positions(positions, matrix, scale, offset)
+    with stats.Stage("normal encoding"):
+      normals = encode_normals(normals, cache)
+    stats.Count("normals encoded", len(normals))
+    with stats.Stage("quantization"):
+      steps, error = quantize_positions(positions)
+    with stats.Stage("bounds"):
+      bounds = frame_bounds(positions, sphere, center)
+    if error[3]:
+      results.append((None, bounds, error))
+      continue
+    with stats.Stage("packing"):
+      records = []
+      for name,verts in parts:
+        if verts is None:
+          records.append(pack_vertices(steps, normals))
+        elif numpy:
+          records.append(pack_vertices(steps[verts], normals[verts]))
+        else:
+          records.append(pack_vertices([steps[vi * 3 + i] for vi in verts for i in range(0,3)], [normals[vi] for vi in verts]))
+    stats.Count("frames packed")
+    results.append((records, bounds, error))
+  return results
+
+def frame_pool(jobs):
+  # worker processes for convert_frames, None for a serial export. Workers
+  # are forked: blender can not start python workers of itself. Forking the
+  # threaded blender process without exec is only safe on linux, elsewhere
+  # (windows, mac os) or on old pythons the export stays serial
+  if jobs == 1 or not sys.platform.startswith("linux"):
+    return None
+  try:
+    import concurrent.futures
+    context = multiprocessing.get_context("fork")
+    return concurrent.futures.ProcessPoolExecutor(jobs or multiprocessing.cpu_count(), mp_context=context)
+  except (ImportError, AttributeError, TypeError, ValueError):
+    return None
+
+def split_triangles(triangles, max_verts, max_tris):
+  # Partitions triangles (vertex index triples) into connected clusters that
+  # each stay below max_verts vertices and max_tris triangles. A cluster grows
+  # breadth first over shared vertices, so it stays spatially coherent and
+  # only its border vertices end up duplicated in the neighbouring clusters.
+  # Returns lists of triangle indexes, each in the original order.
+  vert_tris = {}
+  for t,tri in enumerate(triangles):
+    for vi in tri:
+      vert_tris.setdefault(vi, []).append(t)
+
+  assigned = [False] * len(triangles)
+  clusters = []
+  for seed in range(0, len(triangles)):
+    if assigned[seed]:
+      continue
+    cluster = []
+    verts = set()
+    queue = collections.deque([seed])
+    queued = set([seed])
+    while queue and len(cluster) < max_tris:
+      t = queue.popleft()
+      if assigned[t]:
+        continue
+      new_verts = [vi for vi in set(triangles[t]) if vi not in verts]
+      if len(verts) + len(new_verts) > max_verts:
+        continue
+      assigned[t] = True
+      cluster.append(t)
+      verts.update(new_verts)
+      for vi in triangles[t]:
+        for n in vert_tris[vi]:
+          if not assigned[n] and n not in queued:
+            queued.add(n)
+            queue.append(n)
+    cluster.sort()
+    clusters.append(cluster)
+  return clusters
+
+def measure_acmr(triangles, cache_size=16):
+  # average cache miss ratio (transformed vertices per triangle) of a FIFO
+  # post-transform cache, the usual measure for vertex cache friendliness
+  if not triangles:
+    return 0.0
+  fifo = collections.deque()
+  cached = set()
+  misses = 0
+  for tri in triangles:
+    for vi in tri:
+      if vi not in cached:
+        misses += 1
+        fifo.append(vi)
+        cached.add(vi)
+        if len(fifo) > cache_size:
+          cached.discard(fifo.popleft())
+  return misses / float(len(triangles))
+
+def optimize_vertex_cache(triangles, num_verts, cache_size=32):
+  # Tom Forsyth's linear-speed vertex cache optimisation. Returns the order
+  # to emit the triangles (vertex index triples) in, best scored triangle of
+  # the vertices in a simulated LRU cache first.
+  vert_tris = [[] for vi in range(0, num_verts)]
+  for t,tri in enumerate(triangles):
+    for vi in tri:
+      vert_tris[vi].append(t)
+  cache_pos = [-1] * num_verts
+
+  def vertex_score(vi):
+    if not vert_tris[vi]:
+      return -1.0
+    score = 0.0
+    pos = cache_pos[vi]
+    if pos >= 0:
+      if pos < 3:
+        score = 0.75 # used by the last triangle
+      else:
+        score = math.pow(1.0 - (pos - 3) / float(cache_size - 3), 1.5)
+    return score + 2.0 / math.sqrt(len(vert_tris[vi])) # valence boost
+
+  vscore = [vertex_score(vi) for vi in range(0, num_verts)]
+  tscore = [vscore[a] + vscore[b] + vscore[c] for a,b,c in triangles]
+  emitted = [False] * len(triangles)
+  order = []
+  cache = []
+  scan = 0
+  best = -1
+  if triangles:
+    best = max(range(0, len(triangles)), key=tscore.__getitem__)
+  while best >= 0:
+    emitted[best] = True
+    order.append(best)
+    tri = triangles[best]
+    for vi in tri:
+      if best in vert_tris[vi]:
+        vert_tris[vi].remove(best)
+
+    # the triangle moves to the front of the cache, the rest shifts back
+    front = []
+    for vi in tri:
+      if vi not in front:
+        front.append(vi)
+    cache = front + [vi for vi in cache if vi not in front]
+    touched = cache
+    for pos,vi in enumerate(cache):
+      cache_pos[vi] = pos if pos < cache_size else -1
+    cache = cache[:cache_size]
+
+    for vi in touched:
+      vscore[vi] = vertex_score(vi)
+    best = -1
+    best_score = -1.0
+    for vi in touched:
+      for t in vert_tris[vi]:
+        a,b,c = triangles[t]
+        tscore[t] = vscore[a] + vscore[b] + vscore[c]
+        if cache_pos[vi] >= 0 and tscore[t] > best_score:
+          best = t
+          best_score = tscore[t]
+    if best < 0:
+      # nothing left around the cache, continue with the next unused one
+      while scan < len(triangles) and emitted[scan]:
+        scan += 1
+      if scan < len(triangles):
+        best = scan
+  return order
 
-######Find scale value for fitting very small objects to md3 world space
+def decimate_triangles(positions, triangles, locked, targets):
+  # Quadric error metric (Garland & Heckbert) edge collapses of an indexed
+  # triangle list, positions: flat xyz per vertex. A vertex always collapses
+  # onto one of its neighbours, never to a new position, so the survivors
+  # keep their sampled frames. locked vertices are never removed. One pass
+  # for all of targets (descending triangle counts), returns the triangles
+  # left at each of them
+  num_verts = len(positions) // 3
+  quadrics = [[0.0] * 10 for vi in range(0, num_verts)]
+  vert_tris = [set() for vi in range(0, num_verts)]
+  live = [list(tri) for tri in triangles]
+
+  def normal(tri):
+    p0,p1,p2 = [positions[vi * 3:vi * 3 + 3] for vi in tri]
+    u = [p1[i] - p0[i] for i in range(0,3)]
+    v = [p2[i] - p0[i] for i in range(0,3)]
+    return [u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0]], p0
+
+  ## plane quadric of every triangle, weighted by its area
+  for t,tri in enumerate(live):
+    for vi in tri:
+      vert_tris[vi].add(t)
+    n,p0 = normal(tri)
+    length = math.sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2])
+    if length == 0:
+      continue
+    a,b,c = [x / length for x in n]
+    d = -(a * p0[0] + b * p0[1] + c * p0[2])
+    area = length / 2
+    plane = (a * a, a * b, a * c, a * d, b * b, b * c, b * d, c * c, c * d, d * d)
+    for vi in set(tri):
+      q = quadrics[vi]
+      for i in range(0,10):
+        q[i] += plane[i] * area
+
+  def cost(u, w):
+    # error of moving u onto w under both quadrics
+    q = [qu + qw for qu,qw in zip(quadrics[u], quadrics[w])]
+    x,y,z = positions[w * 3:w * 3 + 3]
+    return (q[0] * x * x + 2 * q[1] * x * y + 2 * q[2] * x * z + 2 * q[3] * x + q[4] * y * y
+      + 2 * q[5] * y * z + 2 * q[6] * y + q[7] * z * z + 2 * q[8] * z + q[9])
+
+  version = [0] * num_verts
+  heap = []
+  def push(u):
+    # cheapest collapse of u, entries of an older version are stale
+    version[u] += 1
+    if locked[u]:
+      return
+    best = None
+    for w in set(w for t in vert_tris[u] for w in live[t]):
+      if w != u:
+        error = cost(u, w)
+        if best is None or error < best[0]:
+          best = (error, w)
+    if best:
+      heapq.heappush(heap, (best[0], u, version[u], best[1]))
+
+  for vi in range(0, num_verts):
+    push(vi)
+  count = len(live)
+  results = []
+  targets = list(targets)
+  while targets:
+    if count <= targets[0] or not heap:
+      results.append([list(tri) for tri in live if tri is not None])
+      targets.pop(0)
+      continue
+    error,u,stamp,w = heapq.heappop(heap)
+    if stamp != version[u]:
+      continue
+
+    ## no triangle kept around u may flip over
+    flipped = False
+    for t in vert_tris[u]:
+      tri = live[t]
+      if w not in tri:
+        before = normal(tri)[0]
+        after = normal([w if vi == u else vi for vi in tri])[0]
+        if before[0] * after[0] + before[1] * after[1] + before[2] * after[2] <= 0:
+          flipped = True
+          break
+    if flipped:
+      continue
+
+    for t in list(vert_tris[u]):
+      tri = live[t]
+      if w in tri:
+        for vi in tri:
+          vert_tris[vi].discard(t)
+        live[t] = None
+        count -= 1
+      else:
+        live[t] = [w if vi == u else vi for vi in tri]
+        vert_tris[w].add(t)
+    vert_tris[u] = set()
+    quadrics[w] = [qu + qw for qu,qw in zip(quadrics[u], quadrics[w])]
+    version[u] += 1
+    for vi in set(vi for t in vert_tris[w] for vi in live[t]):
+      push(vi)
+  return results
+
+def encode_normals(normals, cache=None):
+  # Batch version of md3Vert.Encode, takes N x 3 normals (a flat sequence is
+  # fine too) and returns the packed lat/lng values as an uint16 array.
+  # Results are bit-for-bit those of md3Vert.Encode: angles that land within
+  # rounding distance of a quantization step are redone through math.
+  if numpy:
+    n = numpy.asarray(normals, numpy.float64).reshape(-1, 3)
+    x = n[:, 0]
+    y = n[:, 1]
+    z = n[:, 2]
+    l = numpy.sqrt((x*x) + (y*y) + (z*z))
+    zero = l == 0
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+      x = x/l
+      y = y/l
+      z = z/l
+      lng = numpy.arccos(z) * 255 / (2 * math.pi)
+      lat = numpy.arctan2(y, x) * 255 / (2 * math.pi)
+    for angle,func,args in ((lng, math.acos, (z,)), (lat, math.atan2, (y, x))):
+      edge = numpy.nonzero(numpy.abs(angle - numpy.round(angle)) < 1e-6)[0]
+      for i in edge.tolist():
+        angle[i] = func(*[a[i] for a in args]) * 255 / (2 * math.pi)
+    pole = (x == 0.0) & (y == 0.0)
+    lat = numpy.where(pole | zero, 0, numpy.trunc(lat)).astype(numpy.int64)
+    lng = numpy.where(pole | zero, 0, numpy.trunc(lng)).astype(numpy.int64)
+    retval = ((lat & 0xFF) << 8) | (lng & 0xFF)
+    retval[pole & ~zero & ~(z > 0.0)] = (128 << 8)
+    return retval.astype(numpy.uint16)
+
+  # plain python: the same math with everything bound locally. Normals of
+  # rigid parts repeat from frame to frame, so known ones come from cache
+  sqrt = math.sqrt
+  acos = math.acos
+  atan2 = math.atan2
+  if cache is None:
+    cache = {}
+  elif len(cache) > 65536:
+    cache.clear()
+  retval = array('H')
+  append = retval.append
+  for i in range(0, len(normals), 3):
+    x = normals[i]
+    y = normals[i + 1]
+    z = normals[i + 2]
+    key = (x, y, z)
+    packed = cache.get(key)
+    if packed is None:
+      l = sqrt((x*x) + (y*y) + (z*z))
+      if l == 0:
+        packed = 0
+      else:
+        x = x/l
+        y = y/l
+        z = z/l
+        if (x == 0.0) & (y == 0.0):
+          if z > 0.0:
+            packed = 0
+          else:
+            packed = (128 << 8)
+        else:
+          lng = acos(z) * 255 / (2 * math.pi)
+          lat = atan2(y, x) * 255 / (2 * math.pi)
+          packed = ((int(lat) & 0xFF) << 8) | (int(lng) & 0xFF)
+      cache[key] = packed
+    append(packed)
+  return retval
+
+# unit test for encode_normals, compares a dense sphere sampling against
+# md3Vert.Encode with and without numpy
+class md3NormalEncodeTest:
+  def __init__(self):
+    global numpy
+    normals = array('f', [0.0, 0.0, 0.0, 0.0, 0.0, 2.0, 0.0, 0.0, -1.0, 1.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, -1.0, 0.0])
+    for i in range(0, 257):
+      lng = math.pi * i / 256
+      for j in range(0, 512):
+        lat = 2 * math.pi * j / 512
+        normals.extend((math.cos(lat) * math.sin(lng), math.sin(lat) * math.sin(lng), math.cos(lng)))
+    encoder = md3Vert()
+    expected = [encoder.Encode(normals[i:i + 3]) for i in range(0, len(normals), 3)]
+    has_numpy = numpy
+    try:
+      for backend in (has_numpy, None):
+        numpy = backend
+        if numpy:
+          packed = encode_normals(numpy.array(normals).reshape(-1, 3)).tolist()
+        else:
+          packed = encode_normals(normals).tolist()
+        assert packed == expected
+        print("md3NormalEncodeTest: " + str(len(expected)) + " normals identical (" + ("numpy" if numpy else "python") + ")")
+    finally:
+      numpy = has_numpy
+
+class md3MeshBuilder:
+  # bpy free conversion of one mesh into md3Surface(s). The topology comes
+  # first (AddTriangle), then one AddFrame per exported frame with plain flat
+  # arrays of the source vertices. Build runs once every frame is in, so the
+  # (auto) scale is known by then
+  def __init__(self, name, shader, settings, log=0, stats=None):
+    self.settings = settings
+    self.log = log
+    self.stats = stats or md3Stats()
+    nsurface = md3Surface()
+    nsurface.name = name
+    nsurface.ident = MD3_IDENT
+    nshader = md3Shader()
+    nshader.name = shader
+    nsurface.shaders.append(nshader)
+    nsurface.numShaders = 1
+    self.surface = nsurface
+    self.weld = md3WeldIndex(nsurface)
+    self.vertlist = self.weld.vertlist
+    self.dimensions = [] # object dimensions per frame, for auto scaling
+    self.origins = []    # object location per frame
+    self.samples = []    # (world matrix, positions, normals) per frame
+    self.hashes = []     # content hash per frame, settings.incremental only
+    self.bounds = []     # (mins, maxs, reach) per frame after Build
+    self.centers = []    # frame origin the reach is measured from
+    self.remap = None    # gather indices of vertlist into the frame arrays
+
+  def AddTriangle(self, vert_indexes, uvs):
+    # one triangle as three source vertex indexes and their (u, v)
+    ntri = md3Triangle()
+    for v,vert_index in enumerate(vert_indexes):
+      uv_u = round(uvs[v][0],5)
+      uv_v = round(uvs[v][1],5)
+      ntri.indexes[v] = self.weld.Weld(vert_index, uv_u, uv_v)
+    self.surface.triangles.append(ntri)
+    self.surface.numTriangles += 1
+
+  def AddFrame(self, matrix, positions, normals, origin=(0.0, 0.0, 0.0), dimensions=None, framehash=None):
+    # positions and normals: flat xyz arrays of all source vertices (numpy
+    # float arrays when numpy is used), matrix: 4x4 rows to world space.
+    # Without dimensions (a known bounding box size) auto scaling uses the
+    # extents of positions. framehash saves hashing the same arrays again
+    # for every surface of one object
+    if self.settings.scale == 1:
+      if dimensions is None:
+        dimensions = self.Dimensions(matrix, positions)
+      self.dimensions.append(list(dimensions))
+    self.origins.append(origin)
+    if self.settings.incremental:
+      self.hashes.append(framehash or self.FrameHash(matrix, positions, normals))
+    self.samples.append((matrix, self.Gather(positions), self.Gather(normals)))
+
+  def Dimensions(self, matrix, positions):
+    # what blender calls the object dimensions: the local bounding box size
+    # times the scale of the world matrix (length of its axis columns)
+    if numpy:
+      positions = numpy.asarray(positions).reshape(-1, 3)
+      extents = (positions.max(axis=0) - positions.min(axis=0)).tolist() if len(positions) else [0.0] * 3
+    else:
+      extents = [max(positions[i::3]) - min(positions[i::3]) if len(positions) else 0.0 for i in range(0,3)]
+    return [extents[i] * math.sqrt(matrix[0][i] * matrix[0][i] + matrix[1][i] * matrix[1][i] + matrix[2][i] * matrix[2][i]) for i in range(0,3)]
+
+  def FrameHash(self, matrix, positions, normals):
+    # hash of the evaluated frame, what md3Cache compares between exports
+    key = hashlib.sha1(array('d', [value for row in matrix for value in row]).tobytes())
+    for flat in (positions, normals):
+      if numpy:
+        key.update(numpy.ascontiguousarray(flat, numpy.float32).tobytes())
+      else:
+        key.update(array('f', flat).tobytes())
+    return key.hexdigest()
+
+  def TopologyHash(self):
+    # hash of everything but the frames: names, shader, welding and triangles
+    nsurface = self.surface
+    key = hashlib.sha1(str.encode(nsurface.name + "\0" + nsurface.shaders[0].name))
+    key.update(array('i', self.vertlist).tobytes())
+    key.update(nsurface.UVData().tobytes())
+    key.update(nsurface.TriangleData().tobytes())
+    return key.hexdigest()
+
+  def Gather(self, flat):
+    # picks the xyz triples of vertlist out of a flat frame array
+    if numpy:
+      if self.remap is None:
+        self.remap = numpy.array(self.vertlist, numpy.intp)
+      return numpy.asarray(flat, numpy.float32).reshape(-1, 3)[self.remap]
+    if self.remap is None:
+      self.remap = [vi * 3 + i for vi in self.vertlist for i in range(0,3)]
+    return [flat[i] for i in self.remap]
+
+  def Parts(self):
+    # (md3Surface, welded vertex indexes or None for all of them) to build.
+    # Surfaces over the md3 limits are split into several ones of the same
+    # name and shader when settings.split is on
+    nsurface = self.surface
+    parts = [(nsurface, None)]
+    if self.settings.split and (nsurface.numVerts >= MD3_MAX_VERTICES or nsurface.numTriangles >= MD3_MAX_TRIANGLES):
+      triangles = [t.indexes for t in nsurface.triangles]
+      clusters = split_triangles(triangles, MD3_MAX_VERTICES - 1, MD3_MAX_TRIANGLES - 1)
+      parts = []
+      for cluster in clusters:
+        verts = sorted(set(vi for t in cluster for vi in triangles[t]))
+        parts.append((self.SubSurface([triangles[t] for t in cluster], verts), verts))
+      message(self.log,"Split surface " + nsurface.name + " (" + str(nsurface.numVerts) + " verts, " + str(nsurface.numTriangles) + " tris) into " + str(len(parts)) + " surfaces")
+
+    if self.settings.optimize:
+      parts = [self.Optimize(part, verts) for part,verts in parts]
+    return parts
+
+  def SubSurface(self, triangles, verts):
+    # surface with the given triangles of self.surface, verts lists the
+    # welded vertices it uses, in the order they get stored
+    nsurface = self.surface
+    part = md3Surface()
+    part.name = nsurface.name
+    part.ident = nsurface.ident
+    part.flags = nsurface.flags
+    part.shaders = nsurface.shaders
+    part.numShaders = nsurface.numShaders
+    remap = dict((vi, i) for i,vi in enumerate(verts))
+    for vi in verts:
+      part.uv.append(nsurface.uv[vi])
+    part.numVerts = len(verts)
+    for tri in triangles:
+      ntri = md3Triangle()
+      ntri.indexes = [remap[vi] for vi in tri]
+      part.triangles.append(ntri)
+    part.numTriangles = len(triangles)
+    return part
+
+  def Optimize(self, part, verts):
+    # reorders the triangles for the post-transform cache, then stores the
+    # vertices in the order they are first used for fetch locality
+    triangles = [t.indexes for t in part.triangles]
+    before = measure_acmr(triangles)
+    optimized = [triangles[t] for t in optimize_vertex_cache(triangles, part.numVerts)]
+    if measure_acmr(optimized) < before:
+      triangles = optimized
+    order = []
+    seen = [False] * part.numVerts
+    for tri in triangles:
+      for vi in tri:
+        if not seen[vi]:
+          seen[vi] = True
+          order.append(vi)
+    order.extend(vi for vi in range(0, part.numVerts) if not seen[vi])
+    after = measure_acmr(triangles)
+    message(self.log,"Vertex cache order for " + part.name + ": ACMR " + str(round(before,3)) + " -> " + str(round(after,3)))
+
+    if verts is None:
+      verts = list(range(0, part.numVerts))
+    triangles = [[verts[vi] for vi in tri] for tri in triangles]
+    verts = [verts[vi] for vi in order]
+    return self.SubSurface(triangles, verts), verts
+
+  def Decimate(self, ratios):
+    # a md3MeshBuilder for each ratio of the triangles (levels of detail),
+    # decimated over the rest (first) frame. The survivors of the collapses
+    # are a subset of the welded vertices, so their frames are gathered from
+    # the samples of this builder. Seams and open borders stay as they are
+    nsurface = self.surface
+    rest = self.samples[0][1]
+    if numpy:
+      rest = rest.ravel().tolist()
+    uses = collections.Counter(self.vertlist)
+    locked = [uses[vi] > 1 for vi in self.vertlist]
+    triangles = [t.indexes for t in nsurface.triangles]
+    edges = collections.Counter()
+    for tri in triangles:
+      for a,b in ((tri[0], tri[1]), (tri[1], tri[2]), (tri[2], tri[0])):
+        edges[(min(a, b), max(a, b))] += 1
+    for (a,b),count in edges.items():
+      if count == 1:
+        locked[a] = locked[b] = True
+
+    lods = []
+    targets = [int(nsurface.numTriangles * ratio) for ratio in ratios]
+    for level,kept in enumerate(decimate_triangles(rest, triangles, locked, targets)):
+      verts = sorted(set(vi for tri in kept for vi in tri))
+      lod = md3MeshBuilder(nsurface.name, nsurface.shaders[0].name, self.settings, self.log, self.stats)
+      lod.surface = self.SubSurface(kept, verts)
+      lod.vertlist = [self.vertlist[vi] for vi in verts]
+      lod.dimensions = self.dimensions
+      lod.origins = self.origins
+      lod.hashes = self.hashes
+      if numpy:
+        pick = numpy.array(verts, numpy.intp)
+        lod.samples = [(matrix, positions[pick], normals[pick]) for matrix,positions,normals in self.samples]
+      else:
+        pick = [vi * 3 + i for vi in verts for i in range(0,3)]
+        lod.samples = [(matrix, [positions[i] for i in pick], [normals[i] for i in pick]) for matrix,positions,normals in self.samples]
+      message(self.log,"Level of detail " + str(level + 1) + " of " + nsurface.name + ": " + str(nsurface.numTriangles) + " -> " + str(len(kept)) + " triangles")
+      lods.append(lod)
+    return lods
+
+  def Build(self, frames, previous=None, pool=None):
+    # previous: (surfaces, {frame hash: (frame index, mins, maxs, reach,
+    # frame origin)}) of the last export from md3Cache, matching frames are
+    # spliced from there. The tight radius is measured from the localOrigin
+    # of frames, the game centers its culling sphere there. The other frames are converted by convert_frames, in the
+    # worker processes of pool (see frame_pool) when there is one
+    settings = self.settings
+    stats = self.stats
+    with stats.Stage("surface layout"):
+      parts = self.Parts()
+    offset = [settings.offsetx, settings.offsety, settings.offsetz]
+    cache = {}
+    if previous is not None:
+      surfaces, reuse = previous
+      if len(surfaces) != len(parts) or [s.numVerts for s in surfaces] != [nsurface.numVerts for nsurface,verts in parts]:
+        reuse = {}
+    for nsurface,verts in parts:
+      nsurface.AllocFrames(len(self.samples))
+    self.bounds = [None] * len(self.samples)
+    self.centers = [[float(value) for value in nframe.localOrigin] for nframe in frames]
+    spliced = 0
+    todo = []
+    for frame_index in range(0, len(self.samples)):
+      last = None
+      if previous is not None:
+        last = reuse.get(self.hashes[frame_index])
+      if last and settings.tightradius and last[4] != self.centers[frame_index]:
+        last = None # the radius is around another origin
+      if last:
+        ## unchanged since the last export, copy the packed frame
+        previous_index, low, high, reach, center = last
+        with stats.Stage("splicing"):
+          for (nsurface,verts),surface in zip(parts, surfaces):
+            nsurface.SetFrameData(frame_index, surface.FrameData(previous_index))
+        self.bounds[frame_index] = (low, high, reach)
+        self.samples[frame_index] = None
+        spliced += 1
+      else:
+        todo.append(frame_index)
+
+    layout = [(nsurface.name, verts) for nsurface,verts in parts]
+    def job(chunk):
+      # matrices go as lists, blender ones do not pickle
+      return ([([list(row) for row in self.samples[frame_index][0]],) + self.samples[frame_index][1:] + (self.centers[frame_index],) for frame_index in chunk], settings.scale, offset, settings.tightradius, layout)
+
+    if pool and len(todo) > 1:
+      ## chunks of frames, a few per worker, come back in order
+      size = max(1, len(todo) // (4 * (settings.jobs or multiprocessing.cpu_count())))
+      chunks = [todo[i:i + size] for i in range(0, len(todo), size)]
+      converted = zip(todo, (result for results in pool.map(convert_frames, [job(chunk) for chunk in chunks]) for result in results))
+      stage = "worker conversion"
+    else:
+      converted = ((frame_index, convert_frames(job([frame_index]), cache, stats)[0]) for frame_index in todo)
+      stage = "conversion"
+    largest = total = 0.0
+    count = 0
+    overflows = []
+    with stats.Stage(stage):
+      for frame_index,(records, bounds, error) in converted:
+        if records is None:
+          overflows.append((frame_index, error[2], error[3]))
+        else:
+          for (nsurface,verts),record in zip(parts, records):
+            nsurface.SetFrameRecord(frame_index, record)
+        self.bounds[frame_index] = bounds
+        largest = max(largest, error[0])
+        total += error[1]
+        count += error[2]
+        ## release the float samples as soon as the frame is packed
+        self.samples[frame_index] = None
+    self.samples = []
+    if count:
+      message(self.log,"Quantization error of " + self.surface.name + ": max " + str(round(largest,5)) + ", mean " + str(round(total / count,5)))
+    if overflows:
+      for frame_index,verts,outside in overflows:
+        message(self.log,"Frame " + frames[frame_index].name + " of " + self.surface.name + ": " + str(outside) + " of " + str(verts) + " vertices outside of the md3 range (+-" + str(0x8000 / MD3_XYZ_SCALE) + ")",LOG_WARNING)
+      raise OverflowError("vertices outside of the md3 range in " + str(len(overflows)) + " frames of surface " + self.surface.name + ", lower the scale or center the export")
+
+    ## mins, maxs and the tight radius
+    for nframe,(low, high, reach) in zip(frames, self.bounds):
+      if low is not None:
+        for i in range(0,3):
+          nframe.mins[i] = min(nframe.mins[i],low[i])
+          nframe.maxs[i] = max(nframe.maxs[i],high[i])
+      if reach is not None:
+        nframe.radius = max(nframe.radius,reach)
+    if spliced:
+      stats.Count("frames spliced", spliced)
+      message(self.log,"Reused " + str(spliced) + " of " + str(len(self.bounds)) + " frames of " + self.surface.name + " from the last export")
+    return [nsurface for nsurface,verts in parts]
+
+class md3TagBuilder:
+  # bpy free tag, one world matrix (4x4 rows) per exported frame
+  def __init__(self, name):
+    self.name = name
+    self.matrices = []
+
+  def AddFrame(self, matrix):
+    self.matrices.append(matrix)
+
+  def Build(self, settings, frame_index):
+    # rows like transform_positions: the origin is the translation column,
+    # the md3 axes are the columns of the rotation
+    matrix_world = self.matrices[frame_index]
+    ntag = md3Tag()
+    ntag.name = self.name
+    ntag.origin[0] = round((matrix_world[0][3] * settings.scale) + settings.offsetx,5)
+    ntag.origin[1] = round((matrix_world[1][3] * settings.scale) + settings.offsety,5)
+    ntag.origin[2] = round((matrix_world[2][3] * settings.scale) + settings.offsetz,5)
+    ntag.axis[0] = matrix_world[0][0]
+    ntag.axis[1] = matrix_world[1][0]
+    ntag.axis[2] = matrix_world[2][0]
+    ntag.axis[3] = matrix_world[0][1]
+    ntag.axis[4] = matrix_world[1][1]
+    ntag.axis[5] = matrix_world[2][1]
+    ntag.axis[6] = matrix_world[0][2]
+    ntag.axis[7] = matrix_world[1][2]
+    ntag.axis[8] = matrix_world[2][2]
+    return ntag
+
+def auto_scale(settings, meshes, frames, log=0):
+  # Find scale value for fitting very small objects to md3 world space, from
+  # the dimensions the mesh builders got with their frames
   scale_md3 = True
   if settings.scale != 1:
     scale_md3 = False #Allows manual scaling to override auto scaling
   scene_maxs = [0, 0, 0]
   if scale_md3 == True:
-    for obj in selobjects:
-      if obj.type == 'MESH':
-          
-        # CoDEmanX: Bmesh
-        if not obj.data.tessfaces and obj.data.polygons:
-          obj.data.calc_tessface()
-          
-        obj_maxs = [0] * 3
-        for frame in range(bpy.context.scene.frame_start,bpy.context.scene.frame_end + 1):
-          bpy.context.scene.frame_set(frame)
-          for i in range(0,3):
-            if obj.dimensions[i] == 0:
-              scale_md3 = False #Cancel if any object has an axis dimension of 0 (2D Objects)
-            obj_maxs[i] = round(max(obj_maxs[i],obj.dimensions[i]),5)          
-          if dumpall: message(log,"Object bounds for"+str(frame)+str(obj.dimensions))
-        if dumpall: message(log,"Object maxs"+str(obj_maxs))
-        scene_maxs = max(scene_maxs,obj_maxs)
-      if dumpall: message(log,"Selected objects maxs"+str(scene_maxs))
+    for mesh in meshes:
+      obj_maxs = [0] * 3
+      for frame,dimensions in zip(frames, mesh.dimensions):
+        for i in range(0,3):
+          if dimensions[i] == 0:
+            scale_md3 = False #Cancel if any object has an axis dimension of 0 (2D Objects)
+          obj_maxs[i] = round(max(obj_maxs[i],dimensions[i]),5)          
+        message(log,"Object bounds for"+str(frame)+str(dimensions),LOG_DETAIL)
+      message(log,"Object maxs"+str(obj_maxs),LOG_DETAIL)
+      scene_maxs = max(scene_maxs,obj_maxs)
+    message(log,"Selected objects maxs"+str(scene_maxs),LOG_DETAIL)
     if scale_md3 == True:
       scene_minimum = min(scene_maxs[0],scene_maxs[1],scene_maxs[2])
       scene_maximum = max(scene_maxs[0],scene_maxs[1],scene_maxs[2])
-      if dumpall: message(log,"Selected objects min single axis dimension "+str(scene_minimum))
-      if dumpall: message(log,"Selected objects max single axis dimension "+str(scene_maximum))
+      message(log,"Selected objects min single axis dimension "+str(scene_minimum),LOG_DETAIL)
+      message(log,"Selected objects max single axis dimension "+str(scene_maximum),LOG_DETAIL)
       if scene_minimum < 25:
         my_scale = round(25/scene_minimum,2)
         if scene_maximum * my_scale > 750:#Selected Objects bounding box ratio for auto scale is
@@ -578,228 +1829,1385 @@ def save_md3(settings):###################### MAIN BODY
       settings.scale = my_scale      
       message(log,"Scaling export by a value of " + str(my_scale) + " to fit MD3 space")
 
+def center_offset(settings, meshes, log=0):
+  # Moves the offset so the box around every exported frame is centered on
+  # the origin, the most room for the int16 md3 coordinates. Whole steps,
+  # so the quantization stays the same. Applied once, later builds of the
+  # same export (levels of detail) keep the offset
+  offset = [settings.offsetx, settings.offsety, settings.offsetz]
+  low = high = None
+  for mesh in meshes:
+    for matrix,positions,normals in mesh.samples:
+      bounds = frame_bounds(transform_positions(positions, matrix, settings.scale, offset))
+      if bounds[0] is None:
+        continue
+      if low is None:
+        low, high = bounds[0], bounds[1]
+      low = [min(a, b) for a,b in zip(low, bounds[0])]
+      high = [max(a, b) for a,b in zip(high, bounds[1])]
+  settings.center = False
+  if low is None:
+    return
+  shift = [math.floor(-(a + b) / 2 * MD3_XYZ_SCALE + 0.5) / MD3_XYZ_SCALE for a,b in zip(low, high)]
+  settings.offsetx += shift[0]
+  settings.offsety += shift[1]
+  settings.offsetz += shift[2]
+  message(log,"Centered the export by " + str(shift))
+
+def build_md3(settings, frames, meshes, tags, log=0, cache=None, stats=None):
+  # The bpy free part of the export: md3MeshBuilder and md3TagBuilder objects
+  # holding one sample per entry of frames (the frame numbers) make the
+  # md3Object, which Save writes out. With a md3Cache unchanged frames come
+  # from the last export
+  md3 = md3Object()
+  md3.ident = MD3_IDENT
+  md3.version = MD3_VERSION
+  md3.name = settings.name
+  md3.numFrames = len(frames)
+
+  stats = stats or md3Stats()
+  with stats.Stage("scale scan"):
+    auto_scale(settings, meshes, frames, log)
+  if settings.center:
+    with stats.Stage("centering"):
+      center_offset(settings, meshes, log)
+  pool = None
+  if len(frames) > 1:
+    pool = frame_pool(settings.jobs)
+
 ####### Convert to MD3 
-  for obj in selobjects:
-    if obj.type == 'MESH':
-      convert_to_tris = False      
-      bpy.context.scene.frame_set(bpy.context.scene.frame_start)
+  for frame in frames:
+    nframe = md3Frame()
+    nframe.name = str(frame)
+    md3.frames.append(nframe)
+
+  ## the frame origin follows the first exported object
+  if meshes:
+    for nframe,localOrigin in zip(md3.frames, meshes[0].origins):
+      nframe.localOrigin = localOrigin
+
+  try:
+    for mesh in meshes:
+      previous = None
+      if cache:
+        previous = cache.Previous(settings, mesh)
+      surfaces = mesh.Build(md3.frames, previous, pool)
+      if cache:
+        cache.Record(settings, mesh, list(range(md3.numSurfaces, md3.numSurfaces + len(surfaces))))
+      for nsurface in surfaces:
+        md3.surfaces.append(nsurface)
+        md3.numSurfaces += 1
+  finally:
+    if pool:
+      pool.shutdown()
+
+  ## radius of every frame over all surfaces, the farthest vertex from the
+  ## frame origin when settings.tightradius, else the farther of the mins and maxs corners
+  for nframe in md3.frames:
+    if not settings.tightradius:
+      minlength = math.sqrt(math.pow(nframe.mins[0],2) + math.pow(nframe.mins[1],2) + math.pow(nframe.mins[2],2))
+      maxlength = math.sqrt(math.pow(nframe.maxs[0],2) + math.pow(nframe.maxs[1],2) + math.pow(nframe.maxs[2],2))
+      nframe.radius = max(minlength,maxlength)
+    else:
+      ## the stored vertices are rounded, up to half a step on every axis
+      nframe.radius += math.sqrt(3) / (2 * MD3_XYZ_SCALE)
+    nframe.radius = round(nframe.radius,5)
 
-      for face in obj.data.tessfaces:
-        if (len(face.vertices) > 3) & settings.triangulate == True:
-          convert_to_tris = True                             
-      if convert_to_tris == True:
-        me_SaveMesh = obj.data.copy()      
-        scene = bpy.context.scene      
-        scene.objects.active = obj
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.select_all(action='SELECT')
-        bpy.ops.mesh.quads_convert_to_tris()
-        bpy.ops.object.mode_set(mode='OBJECT')
-        scene.objects.active = actobject      
-        message(log,"Converted quads in UV map of " + obj.name + " to tris.")
-        message(log,"Exporting UV texture coordinates for " + obj.name)
-        message(log,"Exporting " + obj.name)
-        nobj = obj.to_mesh(bpy.context.scene, True, 'PREVIEW')
-        obj.data = me_SaveMesh
-        me_SaveMesh = []        
+  ## tags are stored frame by frame
+  md3.numTags = len(tags)
+  with stats.Stage("tags"):
+    for frame_index in range(0,len(md3.frames)):
+      for tag in tags:
+        md3.tags.append(tag.Build(settings, frame_index))
+  stats.Count("surfaces", md3.numSurfaces)
+  stats.Count("frames", md3.numFrames)
+  return md3
+
+class md3AnimationCfg:
+  # animation.cfg of a model: the header lines (sex, headoffset, footsteps)
+  # as they are and [first frame, frames, looping frames, fps, name] per
+  # animation line, in the order the game reads them
+  def __init__(self):
+    self.header = []
+    self.animations = []
+
+  def Load(self, filepath):
+    file = open(filepath, "r")
+    try:
+      for line in file:
+        line = line.strip()
+        if not line or line.startswith("//"):
+          continue
+        fields = line.split("//", 1)
+        values = fields[0].split()
+        if not self.animations and values and not values[0].lstrip("-").isdigit():
+          self.header.append(line)
+          continue
+        if len(values) < 4:
+          raise ValueError("corrupt animation line in " + filepath + ": " + line)
+        name = fields[1].strip() if len(fields) > 1 else ""
+        self.animations.append([int(values[0]), int(values[1]), int(values[2]), int(values[3]), name])
+    finally:
+      file.close()
+    return self
+
+  def Save(self, filepath):
+    lines = list(self.header)
+    if lines:
+      lines.append("")
+    for first,num,looping,fps,name in self.animations:
+      lines.append("%d\t%d\t%d\t%d\t\t// %s" % (first, num, looping, fps, name))
+    file = open(filepath, "w")
+    file.write("\n".join(lines) + "\n")
+    file.close()
+
+def marker_animations(markers, frame_start, frame_end, fps):
+  # animation.cfg lines of timeline markers, (name, frame) pairs: every
+  # marker starts an animation running up to the next marker or frame_end.
+  # [first scene frame, frames, looping frames, fps, name] per animation,
+  # like in the game's own BOTH_ and TORSO_ animations, jumps and landings
+  # play once
+  markers = sorted((frame, name) for name,frame in markers if frame_start <= frame <= frame_end)
+  animations = []
+  for i,(frame, name) in enumerate(markers):
+    end = frame_end + 1
+    if i + 1 < len(markers):
+      end = markers[i + 1][0]
+    num = end - frame
+    if num < 1:
+      continue # another marker on the same frame
+    once = name.upper().startswith(("BOTH_", "TORSO_", "LEGS_JUMP", "LEGS_LAND"))
+    animations.append([frame, num, 0 if once else num, fps, name])
+  return animations
+
+def export_animations(settings, markers, frame_start, frame_end, fps, log=0):
+  # The scene frames to export and their animation.cfg (in exported frames).
+  # The table is settings.animationcfg, its frame 0 being frame_start, and
+  # with settings.markers the timeline markers, (name, frame) pairs, when
+  # there is none. settings.animations picks the animations to export alone.
+  # The cfg is None when settings.animationcfg is exported as it is or when
+  # there is no table, the frames are empty when no animation is left
+  frames = list(range(frame_start, frame_end + 1))
+  animations = None
+  header = []
+  if settings.animationcfg:
+    try:
+      table = md3AnimationCfg().Load(settings.animationcfg)
+      header = table.header
+      animations = [[frame_start + first, num, looping, rate, name] for first,num,looping,rate,name in table.animations]
+      source = settings.animationcfg
+    except (IOError, OSError, ValueError) as error:
+      message(log,"Can not read " + settings.animationcfg + ": " + str(error),LOG_WARNING)
+  if animations is None and settings.markers:
+    animations = marker_animations(markers, frame_start, frame_end, fps)
+    source = "the timeline markers"
+  if animations is None:
+    if settings.animations:
+      message(log,"Exporting only " + settings.animations + " needs the timeline markers or an animation.cfg, exporting all frames",LOG_WARNING)
+    return frames, None
+  if settings.animations:
+    names = [name.strip() for name in settings.animations.split(",") if name.strip()]
+    missing = [name for name in names if name not in [animation[4] for animation in animations]]
+    if missing:
+      message(log,"No animations " + ", ".join(missing) + " in " + source,LOG_WARNING)
+    animations = [animation for animation in animations if animation[4] in names]
+    frames = [frame for first,num,looping,rate,name in animations for frame in range(first, first + num)]
+    if not frames:
+      message(log,"Nothing to export of " + settings.animations,LOG_WARNING)
+      return frames, None
+  elif source == settings.animationcfg:
+    return frames, None
+  cfg = md3AnimationCfg()
+  cfg.header = list(header)
+  cfg.animations = [[frames.index(first), num, looping, rate, name] for first,num,looping,rate,name in animations]
+  message(log,"Exporting " + str(len(animations)) + " animations of " + source + ", " + str(len(frames)) + " frames")
+  return frames, cfg
+
+def frame_groups(md3, tolerance=0):
+  # For every frame of a built md3 the index of the first frame it repeats,
+  # its own index when it is new. Frames are compared as the packed int16
+  # blocks of all surfaces plus the tags, identical ones through a hash of
+  # the blocks. With tolerance (md3 steps) a frame also repeats the one held
+  # before it when no vertex moved further than that, tags included
+  numFrames = md3.numFrames
+  blocks = []
+  for s in md3.surfaces:
+    if numpy:
+      blocks.append(numpy.frombuffer(s.xyznormals, numpy.int16).reshape(numFrames, s.numVerts, 4))
+    else:
+      blocks.append(s.xyznormals)
+
+  def tags(frame_index):
+    return [value for tag in md3.tags[frame_index * md3.numTags:(frame_index + 1) * md3.numTags] for value in list(tag.origin) + list(tag.axis)]
+
+  def near(a, b):
+    # vertices and tags of frame a within tolerance of frame b
+    if max([abs(x - y) for x,y in zip(tags(a), tags(b))] or [0]) > tolerance / MD3_XYZ_SCALE:
+      return False
+    for s,block in zip(md3.surfaces, blocks):
+      if numpy:
+        if s.numVerts and numpy.abs(block[a, :, :3].astype(numpy.int32) - block[b, :, :3]).max() > tolerance:
+          return False
       else:
-        message(log,"Exporting UV texture coordinates for " + obj.name)
-        message(log,"Exporting " + obj.name)
-        nobj = obj.to_mesh(bpy.context.scene, True, 'PREVIEW')
-     
-      UVImage = nobj.tessface_uv_textures[0] # ERROR: An object needs to be unwrapped. 
-      texCoords = UVImage.data
-      nsurface = md3Surface() 
-      nsurface.name = obj.name
-      nsurface.ident = MD3_IDENT
-      nshader = md3Shader()
-      #Add only 1 shader per surface/object
+        count = s.numVerts * 4
+        for i in range(0, count):
+          if i % 4 != 3 and abs(block[a * count + i] - block[b * count + i]) > tolerance:
+            return False
+    return True
+
+  seen = {}
+  groups = []
+  for frame_index in range(0, numFrames):
+    key = hashlib.sha1(array('f', tags(frame_index)).tobytes())
+    for s,block in zip(md3.surfaces, blocks):
+      if numpy:
+        key.update(block[frame_index].tobytes())
+      else:
+        count = s.numVerts * 4
+        key.update(block[frame_index * count:(frame_index + 1) * count].tobytes())
+    key = key.digest()
+    if key in seen:
+      groups.append(seen[key])
+      continue
+    if tolerance and groups and near(frame_index, groups[-1]):
+      groups.append(groups[-1])
+      continue
+    seen[key] = frame_index
+    groups.append(frame_index)
+  return groups
+
+def compact_frames(groups, cfg, log=0):
+  # Frame order of a compacted md3 (indexes into the exported frames) and
+  # cfg with its animations remapped to it. An animation holding one pose
+  # keeps a single frame, one repeating frames already stored points at
+  # them. Frames of no animation are left out. None when cfg does not fit
+  # the export or leaves no frame
+  if not cfg.animations:
+    message(log,"The animation.cfg has no animations, not compacting",LOG_WARNING)
+    return None
+  order = []
+  remapped = md3AnimationCfg()
+  remapped.header = list(cfg.header)
+  for index,(first, num, looping, fps, name) in enumerate(cfg.animations):
+    if first < 0 or num < 1 or first + num > len(groups):
+      message(log,"Animation " + (name or str(index + 1)) + " (" + str(num) + " frames from " + str(first) + ") is outside of the " + str(len(groups)) + " exported frames, not compacting",LOG_WARNING)
+      return None
+    key = groups[first:first + num]
+    if len(set(key)) == 1:
+      key = key[:1]
+    start = None
+    for i in range(0, len(order) - len(key) + 1):
+      if order[i:i + len(key)] == key:
+        start = i
+        break
+    if start is None:
+      start = len(order)
+      order.extend(key)
+    remapped.animations.append([start, len(key), min(looping, len(key)), fps, name])
+  if not order:
+    message(log,"No frames left after compacting, not compacting",LOG_WARNING)
+    return None
+  return order, remapped
+
+def compact_md3(settings, md3, log=0, stats=None, cfg=None):
+  # The redundant frame analysis of a built md3 and, with settings.compact,
+  # the compaction of md3 along cfg (in exported frames), by default
+  # settings.animationcfg. Returns the frame order (for the levels of
+  # detail) and the remapped animation.cfg, or None when md3 keeps all of
+  # its frames
+  stats = stats or md3Stats()
+  with stats.Stage("frame analysis"):
+    groups = frame_groups(md3, settings.frametolerance)
+  repeats = sum(1 for frame_index,group in enumerate(groups) if group != frame_index)
+  if repeats:
+    message(log,str(repeats) + " of " + str(len(groups)) + " frames repeat an earlier frame")
+  if not settings.compact:
+    return None
+  if cfg is None and not settings.animationcfg:
+    message(log,"Compacting frames needs an animation.cfg",LOG_WARNING)
+    return None
+  if cfg is None:
+    try:
+      cfg = md3AnimationCfg().Load(settings.animationcfg)
+    except (IOError, OSError, ValueError) as error:
+      message(log,"Can not read " + settings.animationcfg + ": " + str(error),LOG_WARNING)
+      return None
+  compacted = compact_frames(groups, cfg, log)
+  if compacted is None:
+    return None
+  order, remapped = compacted
+  md3.SelectFrames(order)
+  stats.Count("frames compacted", len(groups) - len(order))
+  message(log,"Compacted " + str(len(groups)) + " frames to " + str(len(order)))
+  return order, remapped
+
+class md3Cache:
+  # Sidecar of an export (<name>.md3cache, json) with the topology hash of
+  # every object and the hash and bounds of each of its frames. The next
+  # export of the same file splices frames with a known hash from the md3
+  # instead of converting them again. Anything not matching, a changed md3
+  # included, just means a full export
+  version = 3
+
+  def __init__(self, savepath, log=0):
+    self.savepath = savepath
+    self.cachepath = os.path.splitext(savepath)[0] + ".md3cache"
+    self.log = log
+    self.last = {}
+    self.settings = None
+    self.objects = {}
+    self.reader = None
+    try:
+      file = open(self.cachepath, "r")
       try:
-        #Using custom properties allows a longer string
-        nshader.name = obj["md3shader"]#Set Property Value to shader path/filename
+        last = json.load(file)
+      finally:
+        file.close()
+      stat = os.stat(savepath)
+      if last.get("version") == self.version and last.get("size") == stat.st_size and last.get("mtime") == stat.st_mtime:
+        self.reader = md3Reader(savepath)
+        self.last = last
+    except (IOError, OSError, ValueError):
+      pass # no usable last export
+
+  def SettingsHash(self, settings):
+    return hashlib.sha1(str.encode(repr((MD3_VERSION, settings.scale, settings.offsetx, settings.offsety, settings.offsetz, settings.split, settings.optimize, settings.tightradius)))).hexdigest()
+
+  def Previous(self, settings, mesh):
+    # (surfaces, {frame hash: (frame index, mins, maxs, reach, frame origin)}) of mesh in the last
+    # export for md3MeshBuilder.Build, None when nothing can be reused
+    last = self.last.get("objects", {}).get(mesh.surface.name)
+    if not self.reader or not last or not mesh.hashes:
+      return None
+    if self.last.get("settings") != self.SettingsHash(settings) or last["topology"] != mesh.TopologyHash():
+      return None
+    try:
+      surfaces = [self.reader.surfaces[index] for index in last["surfaces"]]
+    except IndexError:
+      return None
+    reuse = {}
+    for frame_index,(frame_hash, low, high, reach, center) in enumerate(last["frames"]):
+      if frame_index < self.reader.numFrames:
+        reuse[frame_hash] = (frame_index, low, high, reach, center)
+    return surfaces, reuse
+
+  def Record(self, settings, mesh, surfaces):
+    # what mesh left in this export, surfaces are its surface indexes
+    self.settings = self.SettingsHash(settings)
+    self.objects[mesh.surface.name] = {
+      "topology": mesh.TopologyHash(),
+      "surfaces": surfaces,
+      "frames": [[frame_hash, low, high, reach, center] for frame_hash,(low, high, reach),center in zip(mesh.hashes, mesh.bounds, mesh.centers)]}
+
+  def Close(self):
+    # the md3 is about to be overwritten
+    if self.reader:
+      self.reader.Close()
+      self.reader = None
+
+  def Save(self):
+    # after the md3 is written, ties the hashes to that very file
+    self.Close()
+    if not self.objects:
+      return
+    stat = os.stat(self.savepath)
+    file = open(self.cachepath, "w")
+    json.dump({"version": self.version, "size": stat.st_size, "mtime": stat.st_mtime, "settings": self.settings, "objects": self.objects}, file)
+    file.close()
+
+# unit test for the bpy free core, a synthetic deforming grid
+class md3CoreTest:
+  def __init__(self, size=64, frames=32):
+    settings = md3Settings(savepath="", name="core_test", logtype="console", triangulate=True, scale=2.0)
+    mesh = md3MeshBuilder("grid", "textures/core_test", settings)
+    for j in range(0, size):
+      for i in range(0, size):
+        a = j * (size + 1) + i
+        uv = [(i / size, j / size), ((i + 1) / size, j / size), ((i + 1) / size, (j + 1) / size), (i / size, (j + 1) / size)]
+        mesh.AddTriangle((a, a + 1, a + size + 2), (uv[0], uv[1], uv[2]))
+        mesh.AddTriangle((a, a + size + 2, a + size + 1), (uv[0], uv[2], uv[3]))
+    tag = md3TagBuilder("tag_test")
+    identity = [[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0], [0.0, 0.0, 0.0, 1.0]]
+    for f in range(0, frames):
+      positions = []
+      normals = []
+      for j in range(0, size + 1):
+        for i in range(0, size + 1):
+          positions.extend((i - size / 2.0, j - size / 2.0, math.sin(i * 0.3 + f * 0.2) * 4))
+          normals.extend((0.0, -0.3, 1.0))
+      mesh.AddFrame(identity, array('f', positions), array('f', normals))
+      ## a quarter turn around z and a translation
+      tag.AddFrame([[0.0, -1.0, 0.0, 5.0], [1.0, 0.0, 0.0, 6.0], [0.0, 0.0, 1.0, 7.0], [0.0, 0.0, 0.0, 1.0]])
+
+    starttime = time.time()
+    md3 = build_md3(settings, list(range(0, frames)), [mesh], [tag])
+    data = io.BytesIO()
+    md3.Save(data)
+    data = data.getvalue()
+    assert len(data) == md3.ofsEnd
+    assert md3.surfaces[0].numVerts == (size + 1) * (size + 1)
+    assert md3.surfaces[0].numTriangles == 2 * size * size
+    assert md3.tags[0].origin == [10.0, 12.0, 14.0]
+    assert md3.tags[0].axis == [0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+    print("md3CoreTest: " + str(len(data)) + " bytes in " + str(round(time.time() - starttime, 3)) + " seconds")
+    self.md3 = md3
+    self.data = data
+
+# unit test for md3Reader, reads the md3CoreTest model back
+class md3ReaderTest:
+  def __init__(self):
+    import tempfile
+    core = md3CoreTest()
+    md3 = core.md3
+    filepath = os.path.join(tempfile.gettempdir(), "md3ReaderTest.md3")
+    file = open(filepath, "wb")
+    file.write(core.data)
+    file.close()
+
+    reader = md3Reader(filepath)
+    assert reader.ident == MD3_IDENT and reader.name == md3.name
+    assert (reader.numFrames, reader.numTags, reader.numSurfaces, reader.ofsEnd) == (md3.numFrames, md3.numTags, md3.numSurfaces, md3.ofsEnd)
+    last = md3.numFrames - 1
+    assert reader.Frame(last).mins == [float(f) for f in array('f', md3.frames[last].mins)]
+    assert reader.Frame(last).name == md3.frames[last].name
+    assert reader.Tag(last, 0).name == "tag_test"
+    surface = reader.surfaces[0]
+    nsurface = md3.surfaces[0]
+    assert surface.name == nsurface.name and surface.Shaders()[0].name == nsurface.shaders[0].name
+    count = nsurface.numVerts * 4
+    frame = surface.XyzNormals(last)
+    assert list(frame.reshape(-1) if numpy else frame) == list(nsurface.xyznormals[last * count:(last + 1) * count])
+    assert len(surface.Triangles()) == (nsurface.numTriangles if numpy else nsurface.numTriangles * 3)
+    del frame
+    reader.Close()
+    os.remove(filepath)
+    print("md3ReaderTest: read frame " + str(last) + " of " + str(md3.numFrames) + ", identical")
+
+# unit test for export_animations, an animation.cfg goes before the timeline
+# markers
+class md3AnimationTableTest:
+  def __init__(self):
+    import tempfile
+    filepath = os.path.join(tempfile.gettempdir(), "md3AnimationTableTest.cfg")
+    table = md3AnimationCfg()
+    table.header = ["sex m", "footsteps normal"]
+    table.animations = [[0, 10, 0, 20, "BOTH_DEATH1"], [10, 5, 5, 15, "LEGS_IDLE"]]
+    table.Save(filepath)
+    markers = [("LEGS_WALK", 1), ("LEGS_IDLE", 8)]
+
+    settings = md3Settings(savepath="", name="table_test", logtype="console", markers=True, animationcfg=filepath)
+    frames, cfg = export_animations(settings, markers, 1, 15, 24)
+    assert frames == list(range(1, 16)) and cfg is None
+    settings.animations = "LEGS_IDLE"
+    frames, cfg = export_animations(settings, markers, 1, 15, 24)
+    assert frames == list(range(11, 16))
+    assert cfg.header == table.header and cfg.animations == [[0, 5, 5, 15, "LEGS_IDLE"]]
+    os.remove(filepath)
+    ## the markers when the animation.cfg is gone
+    frames, cfg = export_animations(settings, markers, 1, 15, 24)
+    assert frames == list(range(8, 16))
+    assert cfg.header == [] and cfg.animations == [[0, 8, 8, 24, "LEGS_IDLE"]]
+    print("md3AnimationTableTest: animation.cfg before the timeline markers")
+
+def validate_md3(filepath):
+  # Structural check of a md3 file: idents, counts against the MD3_MAX_*
+  # limits, every offset and the ofsEnd chain. Returns the problems found,
+  # an empty list for a good file
+  problems = []
+  try:
+    reader = md3Reader(filepath)
+  except (IOError, OSError, ValueError) as err:
+    return [str(err)]
+  try:
+    if reader.ident != MD3_IDENT:
+      problems.append("ident is " + repr(reader.ident) + ", not " + MD3_IDENT)
+    if reader.version != MD3_VERSION:
+      problems.append("version is " + str(reader.version) + ", not " + str(MD3_VERSION))
+    for name,count,limit,least in (("frames", reader.numFrames, MD3_MAX_FRAMES, 1), ("tags", reader.numTags, MD3_MAX_TAGS, 0), ("surfaces", reader.numSurfaces, MD3_MAX_SURFACES, 0)):
+      if count < least or count >= limit:
+        problems.append("number of " + name + " (" + str(count) + "/" + str(limit) + ") out of range")
+    framesize = reader.numFrames * md3Frame.binaryStruct.size
+    tagsize = reader.numFrames * reader.numTags * md3Tag.binaryStruct.size
+    for name,offset,size in (("frames", reader.ofsFrames, framesize), ("tags", reader.ofsTags, tagsize)):
+      if offset < md3Object.binaryStruct.size or offset + size > reader.size:
+        problems.append(name + " (" + str(size) + " bytes at " + str(offset) + ") outside of the file")
+    ## frames, tags and surfaces follow each other without overlapping
+    if reader.ofsTags < reader.ofsFrames + framesize:
+      problems.append("tags at " + str(reader.ofsTags) + " overlap the frames ending at " + str(reader.ofsFrames + framesize))
+    if reader.ofsSurfaces < reader.ofsTags + tagsize:
+      problems.append("surfaces at " + str(reader.ofsSurfaces) + " overlap the tags ending at " + str(reader.ofsTags + tagsize))
+    if reader.ofsEnd != reader.size:
+      problems.append("ofsEnd " + str(reader.ofsEnd) + " does not match the file size " + str(reader.size))
+
+    end = reader.ofsSurfaces
+    for surface in reader.surfaces:
+      where = "surface " + repr(surface.name) + ": "
+      end = surface.offset + surface.ofsEnd
+      if surface.ident != MD3_IDENT:
+        problems.append(where + "ident is " + repr(surface.ident))
+      if surface.numFrames != reader.numFrames:
+        problems.append(where + str(surface.numFrames) + " frames, the header has " + str(reader.numFrames))
+      for name,count,limit in (("shaders", surface.numShaders, MD3_MAX_SHADERS), ("vertices", surface.numVerts, MD3_MAX_VERTICES), ("triangles", surface.numTriangles, MD3_MAX_TRIANGLES)):
+        if count < 0 or count >= limit:
+          problems.append(where + "number of " + name + " (" + str(count) + "/" + str(limit) + ") out of range")
+      blocks = (("triangles", surface.ofsTriangles, surface.numTriangles * md3Triangle.binaryStruct.size),
+                ("shaders", surface.ofsShaders, surface.numShaders * md3Shader.binaryStruct.size),
+                ("uvs", surface.ofsUV, surface.numVerts * md3TexCoord.binaryStruct.size),
+                ("vertices", surface.ofsVerts, surface.numFrames * surface.numVerts * md3Vert.binaryStruct.size))
+      inside = end <= reader.size
+      if not inside:
+        problems.append(where + "ends at " + str(end) + ", outside of the file")
+      for name,offset,size in blocks:
+        if offset < md3Surface.binaryStruct.size or offset + size > surface.ofsEnd:
+          problems.append(where + name + " (" + str(size) + " bytes at " + str(offset) + ") outside of the surface")
+          inside = False
+      previous = None
+      for offset,size,name in sorted((offset, size, name) for name,offset,size in blocks if size > 0):
+        if previous and offset < previous[0] + previous[1]:
+          problems.append(where + name + " at " + str(offset) + " overlaps the " + previous[2] + " ending at " + str(previous[0] + previous[1]))
+          inside = False
+        previous = (offset, size, name)
+      if inside and surface.numTriangles > 0:
+        indexes = surface.Triangles()
+        if numpy:
+          low = int(indexes.min())
+          high = int(indexes.max())
+        else:
+          low = min(indexes)
+          high = max(indexes)
+        if low < 0 or high >= surface.numVerts:
+          problems.append(where + "triangle indexes " + str(low) + ".." + str(high) + " outside of " + str(surface.numVerts) + " vertices")
+        del indexes
+    if end != reader.ofsEnd:
+      problems.append("surfaces end at " + str(end) + ", ofsEnd is " + str(reader.ofsEnd))
+  except ValueError as err:
+    problems.append(str(err))
+  finally:
+    reader.Close()
+  return problems
+
+def diff_xyznormals(a, b, tolerance):
+  # compares two xyz/normal blocks in quantization steps (1/64 units for
+  # xyz, lat/lng steps for normals). Returns (differing verts, max xyz
+  # steps, max normal steps)
+  if numpy:
+    a = a.reshape(-1, 4).astype(numpy.int32)
+    b = b.reshape(-1, 4).astype(numpy.int32)
+    if not len(a):
+      return 0, 0, 0
+    dxyz = numpy.abs(a[:, :3] - b[:, :3]).max(axis=1)
+    na = a[:, 3] & 0xFFFF
+    nb = b[:, 3] & 0xFFFF
+    dlat = numpy.abs((na >> 8) - (nb >> 8))
+    dlng = numpy.abs((na & 0xFF) - (nb & 0xFF))
+    dnormal = numpy.maximum(numpy.minimum(dlat, 256 - dlat), numpy.minimum(dlng, 256 - dlng))
+    differ = (dxyz > tolerance) | (dnormal > tolerance)
+    return int(differ.sum()), int(dxyz.max()), int(dnormal.max())
+  differ = 0
+  max_xyz = 0
+  max_normal = 0
+  for i in range(0, len(a), 4):
+    dxyz = max(abs(a[i] - b[i]), abs(a[i + 1] - b[i + 1]), abs(a[i + 2] - b[i + 2]))
+    na = a[i + 3] & 0xFFFF
+    nb = b[i + 3] & 0xFFFF
+    dlat = abs((na >> 8) - (nb >> 8))
+    dlng = abs((na & 0xFF) - (nb & 0xFF))
+    dnormal = max(min(dlat, 256 - dlat), min(dlng, 256 - dlng))
+    if dxyz > tolerance or dnormal > tolerance:
+      differ += 1
+    max_xyz = max(max_xyz, dxyz)
+    max_normal = max(max_normal, dnormal)
+  return differ, max_xyz, max_normal
+
+def diff_md3(filepath_a, filepath_b, tolerance=0):
+  # Section by section comparison of two md3 files. Vertices may differ by
+  # tolerance quantization steps, frame and tag positions by tolerance/64
+  # units. Returns the differences, an empty list when they match, and like
+  # validate_md3 the error of a file that can not be read
+  float_tolerance = max(tolerance, 1e-5 * MD3_XYZ_SCALE) / MD3_XYZ_SCALE
+  differences = []
+  try:
+    a = md3Reader(filepath_a)
+  except (IOError, OSError, ValueError, struct.error) as err:
+    return [str(err)]
+  try:
+    b = md3Reader(filepath_b)
+  except (IOError, OSError, ValueError, struct.error) as err:
+    a.Close()
+    return [str(err)]
+  try:
+    for name in ("ident", "version", "name", "flags", "numFrames", "numTags", "numSurfaces", "numSkins"):
+      if getattr(a, name) != getattr(b, name):
+        differences.append("header: " + name + " " + repr(getattr(a, name)) + " != " + repr(getattr(b, name)))
+
+    def close(x, y, limit):
+      return max([abs(i - j) for i,j in zip(x, y)] + [0]) <= limit
+
+    def values(view):
+      return view.reshape(-1).tolist() if numpy else list(view)
+
+    numFrames = min(a.numFrames, b.numFrames)
+    differ = []
+    for i in range(0, numFrames):
+      fa = a.Frame(i)
+      fb = b.Frame(i)
+      if fa.name != fb.name or not close(fa.mins + fa.maxs + fa.localOrigin + [fa.radius], fb.mins + fb.maxs + fb.localOrigin + [fb.radius], float_tolerance):
+        differ.append(i)
+    if differ:
+      differences.append("frames: " + str(len(differ)) + " of " + str(numFrames) + " differ, first " + str(differ[0]))
+
+    if a.numTags == b.numTags:
+      differ = []
+      for i in range(0, numFrames):
+        for j in range(0, a.numTags):
+          ta = a.Tag(i, j)
+          tb = b.Tag(i, j)
+          if ta.name != tb.name or not close(ta.origin, tb.origin, float_tolerance) or not close(ta.axis, tb.axis, 1e-5):
+            differ.append((i, j))
+      if differ:
+        differences.append("tags: " + str(len(differ)) + " of " + str(numFrames * a.numTags) + " differ, first tag " + str(differ[0][1]) + " of frame " + str(differ[0][0]))
+
+    for index,(sa,sb) in enumerate(zip(a.surfaces, b.surfaces)):
+      where = "surface " + str(index) + " " + repr(sa.name) + ": "
+      for name in ("name", "flags", "numFrames", "numShaders", "numVerts", "numTriangles"):
+        if getattr(sa, name) != getattr(sb, name):
+          differences.append(where + name + " " + repr(getattr(sa, name)) + " != " + repr(getattr(sb, name)))
+      if [s.name for s in sa.Shaders()] != [s.name for s in sb.Shaders()]:
+        differences.append(where + "shaders differ")
+      if sa.numVerts != sb.numVerts or sa.numTriangles != sb.numTriangles:
+        continue
+      if bytes(sa.reader.Data(sa.offset + sa.ofsTriangles, sa.numTriangles * md3Triangle.binaryStruct.size)) != bytes(sb.reader.Data(sb.offset + sb.ofsTriangles, sb.numTriangles * md3Triangle.binaryStruct.size)):
+        differences.append(where + "triangles differ")
+      if not close(values(sa.UV()), values(sb.UV()), 1e-5):
+        differences.append(where + "uvs differ")
+      differ = []
+      max_xyz = 0
+      max_normal = 0
+      for i in range(0, min(sa.numFrames, sb.numFrames)):
+        count, dxyz, dnormal = diff_xyznormals(sa.XyzNormals(i), sb.XyzNormals(i), tolerance)
+        if count:
+          differ.append(i)
+        max_xyz = max(max_xyz, dxyz)
+        max_normal = max(max_normal, dnormal)
+      if differ:
+        differences.append(where + "vertices differ in " + str(len(differ)) + " frames, first " + str(differ[0]) + ", max " + str(max_xyz) + " xyz / " + str(max_normal) + " normal steps")
+    if len(a.surfaces) != len(b.surfaces):
+      differences.append("surfaces: " + str(len(a.surfaces)) + " != " + str(len(b.surfaces)))
+  except (IOError, OSError, ValueError, struct.error) as err:
+    ## an offset of a corrupt file pointing past its end
+    differences.append("can not compare " + filepath_a + " and " + filepath_b + ": " + str(err))
+  finally:
+    a.Close()
+    b.Close()
+  return differences
+
+def md3_files(paths):
+  # the given files plus every .md3 below the given directories
+  filepaths = []
+  for path in paths:
+    if os.path.isdir(path):
+      for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+          if name.lower().endswith(".md3"):
+            filepaths.append(os.path.join(root, name))
+    else:
+      filepaths.append(path)
+  return filepaths
+
+def validate_files(filepaths, jobs=0):
+  # yields (filepath, problems) in order, many files go through a process
+  # pool of jobs workers (0 for one per cpu)
+  if not jobs:
+    jobs = multiprocessing.cpu_count()
+  if jobs == 1 or len(filepaths) < 2:
+    for filepath in filepaths:
+      yield filepath, validate_md3(filepath)
+    return
+  pool = multiprocessing.Pool(jobs)
+  try:
+    chunksize = max(1, len(filepaths) // (jobs * 4))
+    for filepath,problems in zip(filepaths, pool.imap(validate_md3, filepaths, chunksize)):
+      yield filepath, problems
+  finally:
+    pool.close()
+    pool.join()
+
+################################################################################
+#
+# Blender side of the export: samples the scene into the builders above
+#
+
+class md3MeshExport:
+  # Samples one MESH object into md3MeshBuilders during the timeline sweep,
+  # one builder (surface) per shader of its material slots
+  def __init__(self, obj, settings, log, stats=None):
+    self.obj = obj
+    self.settings = settings
+    self.log = log
+    self.stats = stats or md3Stats()
+    self.builders = []
+
+  def ToMesh(self):
+    # the untouched mesh with modifiers, every frame shares its vertex indices
+    return self.obj.to_mesh(bpy.context.scene, True, 'PREVIEW')
+
+  def Shaders(self):
+    # shader of every material slot: the md3shader custom property of the
+    # material, else its name. The md3shader custom property of the object
+    # (allows a longer string) still puts all of it in one surface
+    obj = self.obj
+    try:
+      return [obj["md3shader"]]#Set Property Value to shader path/filename
+    except:
+      pass
+    shaders = []
+    for slot in obj.material_slots:
+      material = slot.material
+      if not material:
+        shaders.append("NULL")
+        continue
+      try:
+        shaders.append(material["md3shader"])
       except:
-        if obj.active_material:      
-          nshader.name = obj.active_material.name
+        shaders.append(material.name)
+    return shaders or ["NULL"]
+
+  def Setup(self):
+    obj = self.obj
+    log = self.log
+
+    # CoDEmanX: Bmesh
+    if not obj.data.tessfaces and obj.data.polygons:
+      obj.data.calc_tessface()
+
+    message(log,"Exporting UV texture coordinates for " + obj.name)
+    message(log,"Exporting " + obj.name)
+    nobj = self.ToMesh()
+
+    UVImage = nobj.tessface_uv_textures[0] # ERROR: An object needs to be unwrapped. 
+    texCoords = UVImage.data
+    shaders = self.Shaders()
+
+    ## Quads are triangulated here, once, and go to the triangles of the
+    ## shader of their material slot (blender uses the last slot for indexes
+    ## past the end). Like the beauty option of quads_convert_to_tris a quad
+    ## is split along its shorter diagonal, measured on the first frame.
+    ## The triangles keep referring to blender vertex indices (through
+    ## vertlist), so later frames only need the deformed positions and no
+    ## edit mode round trip
+    converted = False
+    triangles = dict((shader, []) for shader in shaders)
+    with self.stats.Stage("triangulation"):
+      verts = nobj.vertices
+      for face,faceTexCoords in zip(nobj.tessfaces, texCoords):
+        if len(face.vertices) == 4 and self.settings.triangulate == True:
+          v0,v1,v2,v3 = [verts[vi].co for vi in face.vertices]
+          if (v1 - v3).length < (v0 - v2).length:
+            corners = ((0, 1, 3), (1, 2, 3))
+          else:
+            corners = ((0, 1, 2), (0, 2, 3))
+          converted = True
+        elif len(face.vertices) == 3:
+          corners = ((0, 1, 2),)
         else:
-          nshader.name = "NULL"      
-      nsurface.shaders.append(nshader)
-      nsurface.numShaders = 1
- 
-      vertlist = []
-      myInt = 0
-      for f,face in enumerate(nobj.tessfaces):
-        faceTexCoords = texCoords[myInt] 
-        myInt = myInt + 1 
-        ntri = md3Triangle()
-
-        if len(face.vertices) != 3:
           message(log,"Found a nontriangle face in object " + obj.name)
           continue
 
-        for v,vert_index in enumerate(face.vertices):
-          uv_u = round(faceTexCoords.uv[v][0],5)
-          uv_v = round(faceTexCoords.uv[v][1],5)
-          match = 0
-          match_index = 0
-          for i,vi in enumerate(vertlist):
-            if vi == vert_index:
-              if nsurface.uv[i].u == uv_u and nsurface.uv[i].v == uv_v:
-                match = 1
-                match_index = i
-
-          if match == 0:
-            vertlist.append(vert_index)
-            ntri.indexes[v] = nsurface.numVerts
-            ntex = md3TexCoord()
-            ntex.u = uv_u
-            ntex.v = uv_v
-            nsurface.uv.append(ntex)
-            nsurface.numVerts += 1
-          else:
-            ntri.indexes[v] = match_index
-        nsurface.triangles.append(ntri)
-        nsurface.numTriangles += 1
-    
-      for frame in range(bpy.context.scene.frame_start,bpy.context.scene.frame_end + 1):
-        bpy.context.scene.frame_set(frame)
-        for face in obj.data.tessfaces:
-          if (len(face.vertices) > 3) & settings.triangulate == True:
-            convert_to_tris = True                             
-        if convert_to_tris == True:
-          me_SaveMesh = obj.data.copy()      
-          scene = bpy.context.scene      
-          scene.objects.active = obj
-          bpy.ops.object.mode_set(mode='EDIT')
-          bpy.ops.mesh.select_all(action='SELECT')
-          bpy.ops.mesh.quads_convert_to_tris()
-          bpy.ops.object.mode_set(mode='OBJECT')
-          scene.objects.active = actobject      
-          if dumpall:message(log,"Converted quads in frame " + str(frame) + " of " + obj.name + " to tris.")
-          if dumpall:message(log,"Exporting frame " + str(frame) + " of " + obj.name)
-          fobj = obj.to_mesh(bpy.context.scene, True, 'PREVIEW')
-          obj.data = me_SaveMesh
-          me_SaveMesh = []        
-        else:
-          if dumpall:message(log,"Exporting frame " + str(frame) + " of " + obj.name)
-          fobj = obj.to_mesh(bpy.context.scene, True, 'PREVIEW')        
-        nframe = md3Frame()
-        nframe.name = str(frame)
-        ## Apply location data from objects and armatures
-        if obj.parent == "True":
-          if obj.parent.name == "Armature":
-            if obj.find_armature() != NULL:
-              skel_loc = obj.parent.location      
-              nframe.localOrigin = obj.location - skel_loc
-              my_matrix = obj.matrix_world * obj.matrix_parent_inverse
-        else:
-          nframe.localOrigin = obj.location
-          my_matrix = obj.matrix_world
-
-        ## Locate, sort, encode verts and normals   
-        for vi in vertlist:
-          vert = fobj.vertices[vi]
-          nvert = md3Vert()
-          nvert.xyz = my_matrix * vert.co
-          nvert.xyz[0] = round((nvert.xyz[0] * settings.scale) + settings.offsetx,5)
-          nvert.xyz[1] = round((nvert.xyz[1] * settings.scale) + settings.offsety,5)
-          nvert.xyz[2] = round((nvert.xyz[2] * settings.scale) + settings.offsetz,5)
-          nvert.normal = nvert.Encode(vert.normal)
-          ## mins, maxs, radius... count frames and surfaces
-          for i in range(0,3):
-            nframe.mins[i] = min(nframe.mins[i],nvert.xyz[i])
-            nframe.maxs[i] = max(nframe.maxs[i],nvert.xyz[i])
-          minlength = math.sqrt(math.pow(nframe.mins[0],2) + math.pow(nframe.mins[1],2) + math.pow(nframe.mins[2],2))
-          maxlength = math.sqrt(math.pow(nframe.maxs[0],2) + math.pow(nframe.maxs[1],2) + math.pow(nframe.maxs[2],2))
-          nframe.radius = round(max(minlength,maxlength),5)
-          nsurface.verts.append(nvert) 
-        md3.frames.append(nframe)
-        nsurface.numFrames += 1
-        bpy.data.meshes.remove(fobj)
-      md3.surfaces.append(nsurface)
-      md3.numSurfaces += 1
-      bpy.data.meshes.remove(nobj)
-      obj = []
-
-    elif obj.type == 'EMPTY':# I think this is all wrong (the matrix locations)
-      md3.numTags += 1
-      for frame in range(bpy.context.scene.frame_start,bpy.context.scene.frame_end + 1):
-        bpy.context.scene.set_frame(frame)     
-        ntag = md3Tag()
-        ntag.name = obj.name
-        ntag.origin[0] = round((obj.matrix_world[3][0] * settings.scale) + settings.offsetx,5)
-        ntag.origin[1] = round((obj.matrix_world[3][1] * settings.scale) + settings.offsety,5)
-        ntag.origin[2] = round((obj.matrix_world[3][2] * settings.scale) + settings.offsetz,5)
-        ntag.axis[0] = obj.matrix_world[0][0]
-        ntag.axis[1] = obj.matrix_world[0][1]
-        ntag.axis[2] = obj.matrix_world[0][2]
-        ntag.axis[3] = obj.matrix_world[1][0]
-        ntag.axis[4] = obj.matrix_world[1][1]
-        ntag.axis[5] = obj.matrix_world[1][2]
-        ntag.axis[6] = obj.matrix_world[2][0]
-        ntag.axis[7] = obj.matrix_world[2][1]
-        ntag.axis[8] = obj.matrix_world[2][2]
-        md3.tags.append(ntag)
-  
-  if bpy.context.selected_objects:
-    file = open(settings.savepath, "wb")
-    md3.Save(file)
-    bpy.context.scene.frame_set(bpy.context.scene.frame_start)
-    print_md3(log,md3,settings.dumpall)
-    file.close()
-    message(log,"MD3 saved to " + settings.savepath)
-    elapsedtime = round(time.clock() - starttime,5)
-    message(log,"Elapsed " + str(elapsedtime) + " seconds")
-    if scale_md3 == True:
-      message(log,"Scaled export by a value of " + str(my_scale) + " to fit MD3 space")      
+        bucket = triangles[shaders[min(face.material_index, len(shaders) - 1)]]
+        for tri in corners:
+          bucket.append(([face.vertices[c] for c in tri], [faceTexCoords.uv[c] for c in tri]))
+
+    ## one surface per used shader, named after the object alone when
+    ## there is only one (as in .skin files). Shaders of the same file name
+    ## in different directories get _2, _3, ... so .skin files can tell
+    ## their surfaces apart
+    used = []
+    for shader in shaders:
+      if triangles[shader] and shader not in used:
+        used.append(shader)
+    names = []
+    for shader in used:
+      name = obj.name
+      if len(used) > 1:
+        name = obj.name + "_" + os.path.basename(shader)
+        if name in names:
+          base = name
+          count = 2
+          while name in names:
+            name = base + "_" + str(count)
+            count += 1
+          message(log,"Surface " + base + " of " + shader + " is already taken, named " + name,LOG_WARNING)
+      names.append(name)
+      builder = md3MeshBuilder(name, shader, self.settings, log, self.stats)
+      with self.stats.Stage("welding"):
+        for vert_indexes,uvs in triangles[shader]:
+          builder.AddTriangle(vert_indexes, uvs)
+      self.stats.Count("triangles", len(triangles[shader]))
+      self.stats.Count("vertices", builder.surface.numVerts)
+      self.builders.append(builder)
+    if len(used) > 1:
+      message(log,"Split " + obj.name + " into " + str(len(used)) + " surfaces by material")
+    if converted:
+      message(log,"Converted quads in UV map of " + obj.name + " to tris.")
+    bpy.data.meshes.remove(nobj)
+
+  def Sample(self, frame):
+    obj = self.obj
+    message(self.log,"Exporting frame " + str(frame) + " of " + obj.name,LOG_DETAIL)
+    fobj = self.ToMesh()
+
+    ## Apply location data from objects and armatures
+    if obj.parent == "True":
+      if obj.parent.name == "Armature":
+        if obj.find_armature() != NULL:
+          skel_loc = obj.parent.location      
+          localOrigin = obj.location - skel_loc
+          my_matrix = obj.matrix_world * obj.matrix_parent_inverse
+    else:
+      localOrigin = obj.location.copy()
+      my_matrix = obj.matrix_world
+
+    ## Pull all coordinates and normals of the frame in bulk, the builder
+    ## keeps the welded ones. The transform waits for the full sweep (scaling)
+    count = len(fobj.vertices)
+    if numpy:
+      co = numpy.empty(count * 3, numpy.float32)
+      no = numpy.empty(count * 3, numpy.float32)
+    else:
+      co = [0.0] * (count * 3)
+      no = [0.0] * (count * 3)
+    fobj.vertices.foreach_get("co", co)
+    fobj.vertices.foreach_get("normal", no)
+    bpy.data.meshes.remove(fobj)
+    ## every surface of the object gathers its vertices from the same arrays
+    dimensions = framehash = None
+    for builder in self.builders:
+      if self.settings.scale == 1 and dimensions is None:
+        dimensions = builder.Dimensions(my_matrix, co)
+      if self.settings.incremental and framehash is None:
+        framehash = builder.FrameHash(my_matrix, co, no)
+      builder.AddFrame(my_matrix.copy(), co, no, localOrigin, dimensions, framehash)
+
+class md3TagExport:
+  # Samples the world matrix of one EMPTY into a md3TagBuilder
+  def __init__(self, obj):
+    self.obj = obj
+    self.builder = md3TagBuilder(obj.name)
+
+  def Sample(self, frame):
+    self.builder.AddFrame(self.obj.matrix_world.copy())
+
+def save_md3(settings):###################### MAIN BODY     
+  starttime = clock()#start timer
+  stats = md3Stats()
+  newlogpath = os.path.splitext(settings.savepath)[0] + ".log"
+  level = log_levels.get(settings.loglevel, LOG_INFO)
+  if settings.dumpall:
+    level = LOG_DETAIL
+  if settings.logtype == "append":
+    log = md3Log(newlogpath,"a",level)
+  elif settings.logtype == "overwrite":
+    log = md3Log(newlogpath,"w",level)
   else:
-    message(log,"Select an object to export!")
-    
-  if log:
-    print("Logged to",newlogpath)
+    log = md3Log(None,"w",level)
+  cache = None
+  try:
+    message(log,"######################BEGIN######################")
+    bpy.ops.object.mode_set(mode='OBJECT')
+    scene = bpy.context.scene
+    selobjects = bpy.context.selected_objects
+    manual_scale = settings.scale
+
+    meshes = []
+    tags = []
+    for obj in selobjects:
+      if obj.type == 'MESH':
+        meshes.append(md3MeshExport(obj, settings, log, stats))
+      elif obj.type == 'EMPTY':
+        tags.append(md3TagExport(obj))
+
+    ## the animations of the animation.cfg or the timeline markers,
+    ## settings.animations picks the ones to export alone
+    fps = int(round(scene.render.fps / scene.render.fps_base))
+    frames, cfg = export_animations(settings, [(marker.name, marker.frame) for marker in scene.timeline_markers], scene.frame_start, scene.frame_end, fps, log)
+    if not frames:
+      return
+    ## a subset goes next to the full model, the animation.cfg of that one
+    ## points at frames a subset does not have
+    if settings.animations and cfg and os.path.isfile(settings.savepath):
+      try:
+        reader = md3Reader(settings.savepath)
+        numFrames = reader.numFrames
+        reader.Close()
+      except (IOError, OSError, ValueError, struct.error):
+        numFrames = 0
+      if numFrames > len(frames):
+        subsetpath = os.path.splitext(settings.savepath)[0] + "_subset.md3"
+        message(log,settings.savepath + " holds " + str(numFrames) + " frames, writing the " + str(len(frames)) + " of " + settings.animations + " to " + subsetpath,LOG_WARNING)
+        settings.savepath = subsetpath
+
+####### Sample every selected object in a single sweep over the timeline
+    for frame in frames:
+      with stats.Stage("frame change"):
+        scene.frame_set(frame)
+      for mesh in meshes:
+        if frame == frames[0]:
+          mesh.Setup()
+        with stats.Stage("sampling"):
+          mesh.Sample(frame)
+      with stats.Stage("sampling"):
+        for tag in tags:
+          tag.Sample(frame)
+
+    ## levels of detail share the samples, they are taken before Build
+    ## releases them
+    builders = [builder for mesh in meshes for builder in mesh.builders]
+    lods = [[] for level in range(0, settings.lods)]
+    if settings.lods:
+      with stats.Stage("decimation"):
+        for builder in builders:
+          for level,lod in enumerate(builder.Decimate([math.pow(settings.lodratio, level + 1) for level in range(0, settings.lods)])):
+            lods[level].append(lod)
+
+    cache = None
+    if settings.incremental:
+      cache = md3Cache(settings.savepath, log)
+    md3 = build_md3(settings, frames, builders, [tag.builder for tag in tags], log, cache, stats)
+    compacted = compact_md3(settings, md3, log, stats, cfg)
+  
+    if bpy.context.selected_objects:
+      if cache:
+        cache.Close()
+        ## the frame hashes would not match the frames of a compacted md3
+        if compacted:
+          cache = None
+      with stats.Stage("writing"):
+        file = open(settings.savepath, "wb")
+        md3.Save(file)
+        file.close()
+      stats.Count("bytes written", md3.ofsEnd)
+      bpy.context.scene.frame_set(bpy.context.scene.frame_start)
+      dumppath = None
+      if settings.dumpall and settings.dumpformat == "csv":
+        dumppath = os.path.splitext(settings.savepath)[0] + ".dump.csv"
+      elif settings.dumpall and settings.dumpformat == "binary":
+        dumppath = os.path.splitext(settings.savepath)[0] + ".dump.bin"
+      print_md3(log,md3,settings.dumpall,dumppath)
+      if cache:
+        cache.Save()
+      message(log,"MD3 saved to " + settings.savepath)
+      if compacted:
+        cfg = compacted[1]
+      if cfg and cfg.animations:
+        ## next to the md3 as the game wants it, but never over the table
+        ## it was remapped from, and a table of only some animations does
+        ## not replace the full one
+        cfgpath = os.path.join(os.path.dirname(settings.savepath), "animation.cfg")
+        if settings.animations or (settings.animationcfg and os.path.abspath(cfgpath) == os.path.abspath(settings.animationcfg)):
+          cfgpath = os.path.splitext(settings.savepath)[0] + ".animation.cfg"
+        ## the sex, headoffset and footsteps lines come from the existing table
+        if not cfg.header:
+          for source in (settings.animationcfg, os.path.join(os.path.dirname(settings.savepath), "animation.cfg")):
+            if source and os.path.isfile(source):
+              try:
+                cfg.header = md3AnimationCfg().Load(source).header
+              except (IOError, OSError, ValueError):
+                pass
+              break
+        cfg.Save(cfgpath)
+        message(log,"animation.cfg saved to " + cfgpath)
+
+      ## name_1.md3, name_2.md3, ... with the scale of the full detail one
+      for level,builders in enumerate(lods):
+        lodpath = os.path.splitext(settings.savepath)[0] + "_" + str(level + 1) + ".md3"
+        cache = None
+        if settings.incremental:
+          cache = md3Cache(lodpath, log)
+        lodmd3 = build_md3(settings, frames, builders, [tag.builder for tag in tags], log, cache, stats)
+        if cache:
+          cache.Close()
+        if compacted:
+          lodmd3.SelectFrames(compacted[0])
+          cache = None
+        with stats.Stage("writing"):
+          file = open(lodpath, "wb")
+          lodmd3.Save(file)
+          file.close()
+        stats.Count("bytes written", lodmd3.ofsEnd)
+        if cache:
+          cache.Save()
+        message(log,"MD3 saved to " + lodpath)
+      elapsedtime = round(clock() - starttime,5)
+      stats.Report(log)
+      if settings.profile:
+        stats.Save(os.path.splitext(settings.savepath)[0] + ".profile.json")
+      message(log,"Elapsed " + str(elapsedtime) + " seconds")
+      if settings.scale != manual_scale:
+        message(log,"Scaled export by a value of " + str(settings.scale) + " to fit MD3 space")      
+    else:
+      message(log,"Select an object to export!")
+  finally:
+    ## the mapping of the last export stays open when the export fails
+    if cache:
+      cache.Close()
+    if log.filepath:
+      print("Logged to",newlogpath)
     log.close()
 
-from bpy.props import *
+# md3Settings keywords a manifest entry may set
+manifest_settings = ("logtype", "loglevel", "dumpall", "dumpformat", "triangulate", "split", "optimize", "incremental", "profile", "tightradius", "center", "markers", "animations", "compact", "animationcfg", "frametolerance", "jobs", "lods", "lodratio", "scale", "offsetx", "offsety", "offsetz")
+
+def load_manifest(manifestpath):
+  # Batch export manifest, json: a list of exports or {"defaults": {...},
+  # "exports": [...]}. An export is
+  #   {"blend": "models/sarge.blend", "output": "out/sarge/upper.md3",
+  #    "objects": ["upper", "tag_head"], "frames": [1, 150],
+  #    "name": "models/players/sarge/upper.md3", "scale": 1.0, ...}
+  # with any of manifest_settings. objects default to every mesh and empty
+  # of the scene, frames to the scene range, "timeout" (seconds) to the one
+  # of the batch. Paths are relative to the manifest
+  file = open(manifestpath, "r")
+  try:
+    manifest = json.load(file)
+  finally:
+    file.close()
+  if isinstance(manifest, list):
+    manifest = {"exports": manifest}
+  base = os.path.dirname(os.path.abspath(manifestpath))
+  entries = []
+  for export in manifest.get("exports", []):
+    entry = dict(manifest.get("defaults", {}))
+    entry.update(export)
+    for key in ("blend", "output"):
+      if key not in entry:
+        raise ValueError("manifest export without " + key + ": " + json.dumps(export))
+      entry[key] = os.path.join(base, entry[key])
+    if entry.get("animationcfg"):
+      entry["animationcfg"] = os.path.join(base, entry["animationcfg"])
+    unknown = set(entry) - set(manifest_settings) - set(("blend", "output", "objects", "frames", "name", "timeout"))
+    if unknown:
+      raise ValueError("unknown manifest keys " + ", ".join(sorted(unknown)))
+    entries.append(entry)
+  return entries
+
+def export_entry(entry):
+  # one manifest export in the running (background) blender
+  scene = bpy.context.scene
+  if "frames" in entry:
+    scene.frame_start, scene.frame_end = entry["frames"]
+  names = entry.get("objects")
+  if names:
+    missing = [name for name in names if name not in scene.objects]
+    if missing:
+      raise ValueError("objects not in " + entry["blend"] + ": " + ", ".join(missing))
+  selected = []
+  for obj in scene.objects:
+    obj.select = obj.name in names if names else obj.type in ('MESH', 'EMPTY')
+    if obj.select:
+      selected.append(obj)
+  if not selected:
+    raise ValueError("nothing to export in " + entry["blend"])
+  scene.objects.active = selected[0]
+  ## unset options are those of File > Export, not of md3Settings
+  keywords = {"logtype": default_logtype, "loglevel": default_loglevel, "dumpall": default_dumpall, "dumpformat": default_dumpformat,
+              "triangulate": default_triangulate, "split": default_split, "optimize": default_optimize, "incremental": default_incremental,
+              "profile": default_profile, "tightradius": default_tightradius, "center": default_center, "markers": default_markers,
+              "compact": default_compact, "frametolerance": default_frametolerance, "jobs": default_jobs, "lods": default_lods,
+              "lodratio": default_lodratio}
+  keywords.update((key, entry[key]) for key in manifest_settings if key in entry)
+  outdir = os.path.dirname(entry["output"])
+  if outdir and not os.path.isdir(outdir):
+    os.makedirs(outdir)
+  save_md3(md3Settings(savepath=entry["output"], name=entry.get("name", ""), **keywords))
+
+def run_entry(manifestpath, index, entry, blender, timeout=0):
+  # one background blender exporting entry, returns its report. A blender
+  # still running after timeout seconds (0 for no limit) is killed
+  starttime = time.time()
+  timeout = entry.get("timeout", timeout)
+  command = [blender, "--background", entry["blend"], "--python", os.path.abspath(__file__), "--", "--batch", manifestpath, "--entry", str(index)]
+  report = {"entry": index, "blend": entry["blend"], "output": entry["output"], "problems": []}
+  try:
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    ## a timer rather than communicate(timeout), which python 3.2 lacks
+    expired = []
+    def kill():
+      expired.append(True)
+      try:
+        process.kill()
+      except OSError:
+        pass # exited meanwhile
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+      timer.start()
+    try:
+      output = process.communicate()[0].decode("utf-8", "replace")
+    finally:
+      if timer:
+        timer.cancel()
+    report["returncode"] = process.returncode
+    if expired:
+      report["problems"].append("blender killed after " + str(timeout) + " seconds")
+  except OSError as err:
+    output = ""
+    report["returncode"] = None
+    report["problems"].append("can not run " + blender + ": " + str(err))
+  if report["returncode"] != 0 and not report["problems"]:
+    report["problems"].append("blender exited with " + str(report["returncode"]))
+  elif report["returncode"] == 0:
+    # blender also exits with 0 when the script fails before it writes
+    if not os.path.exists(entry["output"]) or os.path.getmtime(entry["output"]) < starttime - 1:
+      report["problems"].append("no md3 written")
+    else:
+      report["problems"].extend(validate_md3(entry["output"]))
+  if report["problems"]:
+    report["output_tail"] = output.splitlines()[-20:]
+  report["seconds"] = round(time.time() - starttime, 3)
+  return report
+
+def run_batch(manifestpath, jobs=0, blender="blender", timeout=0):
+  # exports every manifest entry in up to jobs background blenders at once
+  # (0 for one per cpu), yields the reports in manifest order
+  import concurrent.futures
+  entries = load_manifest(manifestpath)
+  manifestpath = os.path.abspath(manifestpath)
+  pool = concurrent.futures.ThreadPoolExecutor(jobs or multiprocessing.cpu_count())
+  try:
+    for report in pool.map(lambda item: run_entry(manifestpath, item[0], item[1], blender, timeout), enumerate(entries)):
+      yield report
+  finally:
+    pool.shutdown()
+
+class console:
+  # command line tools, outside blender or after '--' in
+  # blender --background --python io_export_md3.py -- --validate models/
+  accepted_arguments = ["validate", "diff", "batch=", "entry=", "blender=", "report=", "jobs=", "tolerance=", "timeout=", "help"]
+
+  def usage(self):
+    message(0,"Usage: python io_export_md3.py --validate [--jobs n] file.md3|directory ...")
+    message(0,"       python io_export_md3.py --diff [--tolerance steps] a.md3 b.md3")
+    message(0,"       python io_export_md3.py --batch manifest.json [--jobs n] [--blender path] [--timeout seconds] [--report report.json]")
+    message(0,"Available arguments")
+    for argument in self.accepted_arguments:
+      message(0,"\t--" + argument)
 
-class ExportMD3(bpy.types.Operator):
-  '''Export to .md3'''
-  bl_idname = "export.md3"
-  bl_label = 'Export MD3'
+  def get_parameters(self):
+    # arguments after '--' are for us, all of them outside blender
+    argv = sys.argv[1:]
+    if "--" in sys.argv:
+      argv = sys.argv[sys.argv.index("--") + 1:]
+    try:
+      opts, self.args = getopt.gnu_getopt(argv, "", self.accepted_arguments)
+    except getopt.GetoptError as err:
+      message(0,str(err))
+      self.usage()
+      sys.exit(2)
+
+    for opt, arg in opts:
+      if opt == "--validate":
+        self.command = "validate"
+      elif opt == "--diff":
+        self.command = "diff"
+      elif opt == "--batch":
+        self.command = "batch"
+        self.manifest = arg
+      elif opt == "--entry":
+        try:
+          self.entry = int(arg)
+        except ValueError:
+          message(0,"--entry expected int, received: " + arg)
+          sys.exit(2)
+      elif opt == "--blender":
+        self.blender = arg
+      elif opt == "--report":
+        self.report = arg
+      elif opt == "--jobs":
+        try:
+          self.jobs = int(arg)
+        except ValueError:
+          message(0,"--jobs expected int, received: " + arg)
+          sys.exit(2)
+      elif opt == "--tolerance":
+        try:
+          self.tolerance = int(arg)
+        except ValueError:
+          message(0,"--tolerance expected int, received: " + arg)
+          sys.exit(2)
+      elif opt == "--timeout":
+        try:
+          self.timeout = float(arg)
+        except ValueError:
+          message(0,"--timeout expected number, received: " + arg)
+          sys.exit(2)
+      elif opt == "--help":
+        self.usage()
+        sys.exit(0)
+
+  def validate(self):
+    starttime = time.time()
+    failed = 0
+    filepaths = md3_files(self.args)
+    for filepath,problems in validate_files(filepaths, self.jobs):
+      if problems:
+        failed += 1
+        for problem in problems:
+          message(0,"FAIL " + filepath + ": " + problem)
+      else:
+        message(0,"OK " + filepath)
+    message(0,"Validated " + str(len(filepaths)) + " files, " + str(failed) + " failed in " + str(round(time.time() - starttime,3)) + " seconds")
+    return failed == 0
+
+  def diff(self):
+    if len(self.args) != 2:
+      self.usage()
+      sys.exit(2)
+    differences = diff_md3(self.args[0], self.args[1], self.tolerance)
+    for difference in differences:
+      message(0,difference)
+    if not differences:
+      message(0,"No differences (tolerance " + str(self.tolerance) + ")")
+    return not differences
+
+  def batch(self):
+    if self.entry is not None:
+      # worker: blender --background file.blend --python io_export_md3.py -- --batch manifest.json --entry n
+      if not bpy:
+        message(0,"--entry runs inside blender, use --batch alone to start the exports")
+        sys.exit(2)
+      try:
+        export_entry(load_manifest(self.manifest)[self.entry])
+      except Exception:
+        traceback.print_exc()
+        return False
+      return True
+
+    starttime = time.time()
+    reports = []
+    for report in run_batch(self.manifest, self.jobs, self.blender, self.timeout):
+      reports.append(report)
+      if report["problems"]:
+        message(0,"FAIL " + report["output"] + " (" + str(report["seconds"]) + " seconds)")
+        for problem in report["problems"]:
+          message(0,"  " + problem)
+        for line in report.get("output_tail", []):
+          message(0,"  | " + line)
+      else:
+        message(0,"OK " + report["output"] + " (" + str(report["seconds"]) + " seconds)")
+    failed = len([report for report in reports if report["problems"]])
+    elapsed = round(time.time() - starttime,3)
+    message(0,"Exported " + str(len(reports) - failed) + " of " + str(len(reports)) + " md3 files, " + str(failed) + " failed in " + str(elapsed) + " seconds")
+    if self.report:
+      file = open(self.report, "w")
+      json.dump({"exports": reports, "failed": failed, "seconds": elapsed}, file, indent=1)
+      file.close()
+    return failed == 0
+
+  def __init__(self):
+    self.command = None
+    self.args = []
+    self.jobs = 0
+    self.tolerance = 0
+    self.timeout = 3600 ## seconds per export, 0 for no limit
+    self.manifest = None
+    self.entry = None
+    self.blender = os.environ.get("BLENDER", "blender")
+    self.report = None
+    self.get_parameters()
+    if self.command == "validate":
+      sys.exit(0 if self.validate() else 1)
+    elif self.command == "diff":
+      sys.exit(0 if self.diff() else 1)
+    elif self.command == "batch":
+      sys.exit(0 if self.batch() else 1)
+    self.usage()
+    sys.exit(2)
+
+if bpy:
+  from bpy.props import *
+
+  class ExportMD3(bpy.types.Operator):
+    '''Export to .md3'''
+    bl_idname = "export.md3"
+    bl_label = 'Export MD3'
     
-  logenum = [("console","Console","log to console"),
-             ("append","Append","append to log file"),
-             ("overwrite","Overwrite","overwrite log file")]
-
-  filepath = StringProperty(subtype = 'FILE_PATH',name="File Path", description="Filepath for exporting", maxlen= 1024, default="")
-  md3name = StringProperty(name="MD3 Name", description="MD3 header name / skin path (64 bytes)",maxlen=64,default="")
-  md3logtype = EnumProperty(name="Save log", items=logenum, description="File logging options",default =str(default_logtype))
-  md3dumpall = BoolProperty(name="Dump all", description="Dump all data for md3 to log",default=default_dumpall)
-  md3triangulate = BoolProperty(name="Triangulate", description="Triangulate mesh during export",default=default_triangulate)
-  md3scale = FloatProperty(name="Manual Scale", description="Manually scale all objects from world origin (0,0,0) Overrides auto scaling",default=1.0,precision=5)
-  md3offsetx = FloatProperty(name="Offset X", description="Transition scene along x axis",default=0.0,precision=5)
-  md3offsety = FloatProperty(name="Offset Y", description="Transition scene along y axis",default=0.0,precision=5)
-  md3offsetz = FloatProperty(name="Offset Z", description="Transition scene along z axis",default=0.0,precision=5)
-
-  def execute(self, context):
-   settings = md3Settings(savepath = self.properties.filepath,
-                          name = self.properties.md3name,
-                          logtype = self.properties.md3logtype,
-                          dumpall = self.properties.md3dumpall,
-                          triangulate = self.properties.md3triangulate,
-                          scale = self.properties.md3scale,
-                          offsetx = self.properties.md3offsetx,
-                          offsety = self.properties.md3offsety,
-                          offsetz = self.properties.md3offsetz)
-   save_md3(settings)
-   return {'FINISHED'}
-
-  def invoke(self, context, event):
-    wm = context.window_manager
-    wm.fileselect_add(self)
-    return {'RUNNING_MODAL'}
-
-  @classmethod
-  def poll(cls, context):
-    return context.active_object != None
+    logenum = [("console","Console","log to console"),
+               ("append","Append","append to log file"),
+               ("overwrite","Overwrite","overwrite log file")]
+    levelenum = [("warning","Warning","only log warnings"),
+                 ("info","Info","log the export steps"),
+                 ("detail","Detail","log every object and frame")]
+    dumpenum = [("text","Text","dump all data to the log"),
+                ("csv","CSV","dump vertices to a .dump.csv file"),
+                ("binary","Binary","dump vertices to a .dump.bin file")]
+
+    filepath = StringProperty(subtype = 'FILE_PATH',name="File Path", description="Filepath for exporting", maxlen= 1024, default="")
+    md3name = StringProperty(name="MD3 Name", description="MD3 header name / skin path (64 bytes)",maxlen=64,default="")
+    md3logtype = EnumProperty(name="Save log", items=logenum, description="File logging options",default =str(default_logtype))
+    md3loglevel = EnumProperty(name="Log level", items=levelenum, description="Verbosity of the log",default=str(default_loglevel))
+    md3dumpall = BoolProperty(name="Dump all", description="Dump all data for md3 to log",default=default_dumpall)
+    md3dumpformat = EnumProperty(name="Dump format", items=dumpenum, description="Where dump all puts the vertices",default=str(default_dumpformat))
+    md3triangulate = BoolProperty(name="Triangulate", description="Triangulate mesh during export",default=default_triangulate)
+    md3split = BoolProperty(name="Split surfaces", description="Split surfaces over the MD3 vertex/triangle limits into several surfaces",default=default_split)
+    md3optimize = BoolProperty(name="Optimize vertex cache", description="Reorder triangles and vertices for the GPU vertex cache",default=default_optimize)
+    md3incremental = BoolProperty(name="Incremental", description="Keep frame hashes next to the md3 and reuse unchanged frames on the next export",default=default_incremental)
+    md3tightradius = BoolProperty(name="Tight radius", description="Frame radius from the farthest vertex instead of the bounding box corners",default=default_tightradius)
+    md3center = BoolProperty(name="Center", description="Offset the export to the middle of the MD3 coordinate range, moves it against its origin",default=default_center)
+    md3markers = BoolProperty(name="Animation.cfg from markers", description="Every timeline marker starts an animation, written to animation.cfg next to the md3",default=default_markers)
+    md3animations = StringProperty(name="Animations", description="Names (comma separated) of the only animations of the animation.cfg or the markers to export, empty for all",maxlen=1024,default="")
+    md3compact = BoolProperty(name="Compact frames", description="Store repeated frames and held poses once and write animation.cfg remapped to them",default=default_compact)
+    md3animationcfg = StringProperty(subtype = 'FILE_PATH',name="Animation.cfg", description="animation.cfg of the timeline, for compacting frames",maxlen= 1024,default="")
+    md3frametolerance = IntProperty(name="Frame tolerance", description="MD3 steps (1/64 unit) a vertex may move in a frame still counting as held",default=default_frametolerance,min=0,max=64)
+    md3jobs = IntProperty(name="Jobs", description="Worker processes converting frames, 0 for one per CPU (Linux only)",default=default_jobs,min=0,max=64)
+    md3lods = IntProperty(name="Levels of detail", description="Also write decimated name_1.md3, name_2.md3, ... from the same sampling",default=default_lods,min=0,max=4)
+    md3lodratio = FloatProperty(name="LOD ratio", description="Triangles kept from one level of detail to the next",default=default_lodratio,min=0.05,max=0.95,precision=2)
+    md3profile = BoolProperty(name="Profile", description="Save the stage timings of the log as json next to the md3",default=default_profile)
+    md3scale = FloatProperty(name="Manual Scale", description="Manually scale all objects from world origin (0,0,0) Overrides auto scaling",default=1.0,precision=5)
+    md3offsetx = FloatProperty(name="Offset X", description="Transition scene along x axis",default=0.0,precision=5)
+    md3offsety = FloatProperty(name="Offset Y", description="Transition scene along y axis",default=0.0,precision=5)
+    md3offsetz = FloatProperty(name="Offset Z", description="Transition scene along z axis",default=0.0,precision=5)
+
+    def execute(self, context):
+     settings = md3Settings(savepath = self.properties.filepath,
+                            name = self.properties.md3name,
+                            logtype = self.properties.md3logtype,
+                            dumpall = self.properties.md3dumpall,
+                            loglevel = self.properties.md3loglevel,
+                            dumpformat = self.properties.md3dumpformat,
+                            triangulate = self.properties.md3triangulate,
+                            split = self.properties.md3split,
+                            optimize = self.properties.md3optimize,
+                            incremental = self.properties.md3incremental,
+                            profile = self.properties.md3profile,
+                            tightradius = self.properties.md3tightradius,
+                            center = self.properties.md3center,
+                            markers = self.properties.md3markers,
+                            animations = self.properties.md3animations,
+                            compact = self.properties.md3compact,
+                            animationcfg = self.properties.md3animationcfg,
+                            frametolerance = self.properties.md3frametolerance,
+                            jobs = self.properties.md3jobs,
+                            lods = self.properties.md3lods,
+                            lodratio = self.properties.md3lodratio,
+                            scale = self.properties.md3scale,
+                            offsetx = self.properties.md3offsetx,
+                            offsety = self.properties.md3offsety,
+                            offsetz = self.properties.md3offsetz)
+     try:
+       save_md3(settings)
+     except OverflowError as err:
+       self.report({'ERROR'}, str(err))
+       return {'CANCELLED'}
+     return {'FINISHED'}
+
+    def invoke(self, context, event):
+      wm = context.window_manager
+      wm.fileselect_add(self)
+      return {'RUNNING_MODAL'}
+
+    @classmethod
+    def poll(cls, context):
+      return context.active_object != None
 
 def menu_func(self, context):
   self.layout.operator(ExportMD3.bl_idname, text="MD3 (+shaders)", icon='BLENDER')
@@ -813,4 +3221,12 @@ def unregister():
   bpy.types.INFO_MT_file_export.remove(menu_func)
 
 if __name__ == "__main__":
-  register()
+  #md3WeldIndexTest()
+  #md3NormalEncodeTest()
+  #md3CoreTest()
+  #md3ReaderTest()
+  #md3AnimationTableTest()
+  if bpy and "--" not in sys.argv:
+    register()
+  else:
+    console()